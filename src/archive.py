@@ -0,0 +1,102 @@
+"""
+archive.py - compressed segments for messages that left the window
+
+A room can keep the messages its window evicts in an archive: a
+directory of gzip-compressed JSON-lines segments (000001.jsonl.gz, ...).
+Each write() adds one gzip member to the newest segment.  Once a segment
+holds segment_bytes a new one is started, and with max_segments set the
+oldest segments are deleted, so the archive's size on disk stays
+bounded.  read() gives the archived messages back, oldest first.
+"""
+
+import gzip
+import json
+import os
+import threading
+import zlib
+
+SUFFIX = '.jsonl.gz'
+
+
+class Archive:
+    def __init__(self, directory, segment_bytes=1 << 20, max_segments=None, level=6):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.level = level
+        self.lock = threading.Lock()
+        self.current = None  # path of the segment being written
+        self.archived = 0    # messages written by this process
+
+    def write(self, messages):
+        """Append messages to the archive as one compressed member."""
+        if not messages:
+            return
+        data = b''.join(json.dumps(message).encode('utf-8') + b'\n' for message in messages)
+        member = gzip.compress(data, self.level)
+        with self.lock:
+            path = self._segment()
+            with open(path, 'ab') as f:
+                f.write(member)
+            self.archived += len(messages)
+
+    def segments(self):
+        """Paths of the segments, oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name)
+                for name in sorted(n for n in names if n.endswith(SUFFIX))]
+
+    def read(self, since=None):
+        """Yield the archived messages (with an id above since), oldest first."""
+        for path in self.segments():
+            try:
+                with gzip.open(path, 'rb') as f:
+                    for line in f:
+                        message = json.loads(line)
+                        if since is None or message.get('id', 0) > since:
+                            yield message
+            except (EOFError, gzip.BadGzipFile, zlib.error, ValueError):
+                # a member cut short by a crash ends the segment
+                continue
+            except FileNotFoundError:
+                continue  # pruned while we were reading
+
+    def stats(self):
+        segments = self.segments()
+        size = 0
+        for path in segments:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return {'directory': self.directory,
+                'segments': len(segments),
+                'bytes': size,
+                'archived': self.archived}
+
+    def _segment(self):
+        # the segment to append to, starting a new one when it is full
+        if self.current is not None:
+            try:
+                if os.path.getsize(self.current) < self.segment_bytes:
+                    return self.current
+            except FileNotFoundError:
+                pass
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self.segments()
+        if segments and os.path.getsize(segments[-1]) < self.segment_bytes:
+            # after a restart, or another process started a new segment already
+            self.current = segments[-1]
+            return self.current
+        number = int(os.path.basename(segments[-1])[:-len(SUFFIX)]) + 1 if segments else 1
+        self.current = os.path.join(self.directory, '%06d%s' % (number, SUFFIX))
+        if self.max_segments:
+            for path in segments[:max(0, len(segments) + 1 - self.max_segments)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return self.current
@@ -0,0 +1,694 @@
+"""
+benchmark.py - performance checks for Eliza and the channel
+
+Runs a fixed, seeded corpus (greetings, profanity, keysmashes, rule
+hits and catch-all chatter) through Eliza and the channel's POST and GET paths
+and writes throughput and latency percentiles as JSON.  Compare against
+a saved baseline before deploying a new rule set:
+
+    python benchmark.py --save-baseline baseline.json
+    ... change things ...
+    python benchmark.py --baseline baseline.json
+
+The second run exits with status 1 if a result got slower than the
+baseline by more than --tolerance.
+
+The channel.concurrent.* benchmarks post from --posters processes at
+once against one message backend and count the messages that got lost;
+channel.concurrent.json is the old read-and-rewrite messages.json file.
+
+The client.show_channel* benchmarks view channel pages through the
+client against local channel servers; the *unpooled ones open a new
+connection per request, as the client used to.
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import eliza
+from eliza import Eliza, is_keysmash
+from profanity_filter import DEFAULT_FILTER
+
+GREETINGS = ["hi", "Hi there", "hey eliza", "hello everyone", "Hallo!"]
+PROFANITY = ["this is shit", "fuck this", "you are an asshole", "what the hell, b1tch",
+             "damn it all to hell"]
+KEYSMASHES = ["asdfghjkl", "qwrtzpsdf", "jkjkjkjkl", "fdsgdfhgfjh", "xcvbnmmm"]
+RULE_STARTS = ["I am", "I'm", "I feel", "I need", "I want", "I think", "I can't",
+               "I don't", "Why don't you", "Why can't I", "Can you", "Are you",
+               "What", "How", "Because", "My", "You", "Is it", "It is",
+               "I hate", "I'm afraid of", "I don't know"]
+WORDS = ("the a my your today work job sleep coffee dog cat friend mother father "
+         "child computer really very always never sad happy tired angry lonely "
+         "good bad sure know anything everything about it so").split()
+FILLERS = ["ok", "lol", "well", "so", "today", "it was", "nothing much", "yes", "no"]
+MIX = (('greeting', 0.1), ('profanity', 0.05), ('keysmash', 0.05),
+       ('rule', 0.5), ('catchall', 0.3))
+
+
+def make_corpus(count, seed=0):
+    """Return count (kind, message) pairs drawn from a fixed mix."""
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    corpus = []
+    for kind in rng.choices(kinds, weights, k=count):
+        body = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+        if kind == 'greeting':
+            text = rng.choice(GREETINGS)
+        elif kind == 'profanity':
+            text = rng.choice(PROFANITY)
+        elif kind == 'keysmash':
+            text = rng.choice(KEYSMASHES)
+        elif kind == 'rule':
+            text = rng.choice(RULE_STARTS) + ' ' + body
+        else:
+            text = rng.choice(FILLERS) + ' ' + body
+        if kind in ('rule', 'catchall') and rng.random() < 0.2:
+            text += '?'
+        corpus.append((kind, text))
+    return corpus
+
+
+def summarize(latencies, elapsed):
+    """Throughput and latency percentiles for per-call latencies in seconds."""
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1e6
+
+    return {'calls': len(ordered),
+            'ops_per_sec': len(ordered) / elapsed if elapsed else None,
+            'mean_us': sum(ordered) / len(ordered) * 1e6,
+            'p50_us': percentile(50),
+            'p99_us': percentile(99)}
+
+
+def time_calls(func, args):
+    """Call func(*a) for every a in args, timing each call."""
+    clock = time.perf_counter
+    latencies = []
+    start = clock()
+    for arg in args:
+        call_start = clock()
+        func(*arg)
+        latencies.append(clock() - call_start)
+    return summarize(latencies, clock() - start)
+
+
+def bench_respond(corpus, seed):
+    therapist = Eliza()
+    rng = random.Random(seed)
+    return time_calls(lambda text: therapist.respond(text, 'bench', rng),
+                      [(text,) for _, text in corpus])
+
+
+def sequential_match(keys, text):
+    # how respond() found its rule before RuleIndex: every regex in turn
+    for i, key in enumerate(keys):
+        match = key.match(text)
+        if match:
+            return i, match.groups()
+    return None
+
+
+def bench_match_rules(corpus, seed, sequential=False):
+    # rule matching alone, without respond()'s cache of earlier matches
+    from eliza import DEFAULT_RULES, Utterance
+    texts = [Utterance(text) for _, text in corpus]
+    if sequential:
+        keys = DEFAULT_RULES.keys
+        return time_calls(lambda text: sequential_match(keys, text),
+                          [(norm.text,) for norm in texts])
+    return time_calls(DEFAULT_RULES.index.match, [(norm.text, norm.lowered) for norm in texts])
+
+
+def bench_respond_many(corpus, seed):
+    therapist = Eliza()
+    texts = [text for _, text in corpus]
+    start = time.perf_counter()
+    therapist.respond_many(texts, 'bench', random.Random(seed))
+    elapsed = time.perf_counter() - start
+    return {'calls': len(texts), 'ops_per_sec': len(texts) / elapsed}
+
+
+def bench_keysmash(corpus, seed):
+    return time_calls(is_keysmash, [(text,) for _, text in corpus])
+
+
+def bench_translate(corpus, seed):
+    therapist = Eliza()
+    return time_calls(lambda text: therapist.translate(text, eliza.gReflections),
+                      [(text,) for _, text in corpus])
+
+
+def bench_profanity(corpus, seed):
+    return time_calls(DEFAULT_FILTER.scan, [(text,) for _, text in corpus])
+
+
+# message sizes for the comparison with better_profanity: (words, chars, messages timed)
+PROFANITY_SIZES = {'10_words': (10, None, 200),
+                   '100_words': (100, None, 20),
+                   '5k_chars': (None, 5000, 2)}
+
+
+def sized_messages(corpus, seed, words, chars, count):
+    # count messages of the corpus' words (profanity included), words long or chars long
+    rng = random.Random(seed)
+    vocabulary = [word for _, text in corpus for word in text.split()]
+    messages = []
+    for _ in range(count):
+        picked = []
+        while (len(picked) < words) if words else (len(' '.join(picked)) < chars):
+            picked.append(rng.choice(vocabulary))
+        messages.append(' '.join(picked)[:chars] if chars else ' '.join(picked))
+    return messages
+
+
+def better_profanity_scan(text):
+    # what channel.py did before the trie: two passes over the text
+    from better_profanity import profanity
+    return profanity.contains_profanity(text), profanity.censor(text)
+
+
+def bench_profanity_size(size, scan, corpus, seed):
+    words, chars, count = PROFANITY_SIZES[size]
+    result = time_calls(scan, [(text,) for text in sized_messages(corpus, seed, words, chars, count)])
+    result['size'] = size
+    return result
+
+
+def temporary_store(channel, directory):
+    from message_store import MessageStore
+    return MessageStore(os.path.join(directory, 'messages.jsonl'),
+                        window=channel.CHANNEL_WINDOW - 1, welcome=channel.welcome_message)
+
+
+def bench_send_message(corpus, seed, posts=2000, replies_async=False):
+    import channel
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = channel.MAIN_ROOM.store, channel.ELIZA_ASYNC
+        channel.ELIZA_ASYNC = replies_async
+        channel.MAIN_ROOM.store = temporary_store(channel, tmp)
+        try:
+            client = channel.app.test_client()
+            headers = {'Authorization': 'authkey ' + channel.CHANNEL_AUTHKEY}
+
+            def post(text):
+                response = client.post('/', headers=headers,
+                                       json={'content': text, 'sender': 'bench',
+                                             'timestamp': '2024-01-01T00:00:00'})
+                if response.status_code != 200:
+                    raise RuntimeError("POST failed: %s" % response.status_code)
+
+            random.seed(seed)
+            result = time_calls(post, [(text,) for _, text in corpus[:posts]])
+            if replies_async:
+                # how long the workers still needed for the queued replies
+                start = time.perf_counter()
+                channel.REPLIES.join()
+                result['drain_ms'] = (time.perf_counter() - start) * 1e3
+                result['mean_batch'] = channel.REPLIES.stats()['mean_batch']
+            return result
+        finally:
+            channel.MAIN_ROOM.store.close()
+            channel.MAIN_ROOM.store, channel.ELIZA_ASYNC = saved
+
+
+def bench_batch(corpus, seed, size=10000):
+    # POST /batch with up to size messages each; calls are messages here
+    import channel
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = channel.MAIN_ROOM.store
+        channel.MAIN_ROOM.store = temporary_store(channel, tmp)
+        try:
+            client = channel.app.test_client()
+            headers = {'Authorization': 'authkey ' + channel.CHANNEL_AUTHKEY}
+            messages = [{'content': text, 'sender': 'bench', 'timestamp': '2024-01-01T00:00:00'}
+                        for _, text in corpus]
+            random.seed(seed)
+            start = time.perf_counter()
+            for offset in range(0, len(messages), size):
+                response = client.post('/batch', headers=headers,
+                                       json=messages[offset:offset + size])
+                if response.status_code != 200 or response.json['rejected']:
+                    raise RuntimeError("POST /batch failed: %s" % response.status_code)
+            elapsed = time.perf_counter() - start
+            return {'calls': len(messages), 'ops_per_sec': len(messages) / elapsed,
+                    'batch_size': size}
+        finally:
+            channel.MAIN_ROOM.store.close()
+            channel.MAIN_ROOM.store = saved
+
+
+def bench_get_messages(corpus, seed, window=24, gets=2000, accept_gzip=False):
+    # GET / on a full window that doesn't change between requests
+    import channel
+    from message_store import MessageStore
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = channel.MAIN_ROOM.store
+        channel.MAIN_ROOM.store = MessageStore(os.path.join(tmp, 'messages.jsonl'),
+                                               window=window, welcome=channel.welcome_message)
+        try:
+            channel.MAIN_ROOM.store.append(*[{'content': text, 'sender': 'bench',
+                                              'timestamp': '2024-01-01T00:00:00'}
+                                             for _, text in corpus[:window]])
+            client = channel.app.test_client()
+            headers = {'Authorization': 'authkey ' + channel.CHANNEL_AUTHKEY}
+            if accept_gzip:
+                headers['Accept-Encoding'] = 'gzip'
+
+            def get():
+                response = client.get('/', headers=headers)
+                if response.status_code != 200:
+                    raise RuntimeError("GET failed: %s" % response.status_code)
+
+            result = time_calls(get, [()] * gets)
+            result['window'] = window
+            return result
+        finally:
+            channel.MAIN_ROOM.store.close()
+            channel.MAIN_ROOM.store = saved
+
+
+class LegacyJsonFile:
+    """The old messages.json handling: read and rewrite the file per message."""
+
+    def __init__(self, path, window):
+        self.path = path
+        self.window = window
+
+    def messages(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []  # what read_messages did with a truncated file
+
+    def append(self, *messages):
+        # numbered like the other stores (the last id goes to the stream feed), just as racy
+        stored = []
+        for message in messages:
+            current = self.messages()
+            message = {**message, 'id': current[-1].get('id', 0) + 1 if current else 1}
+            current.append(message)
+            with open(self.path, 'w') as f:
+                json.dump(current[-self.window:], f)
+            stored.append(message)
+        return stored
+
+    def close(self):
+        pass
+
+
+def open_backend(backend, directory, window):
+    import channel
+    if backend == 'json':
+        return LegacyJsonFile(os.path.join(directory, 'messages.json'), window)
+    channel.CHANNEL_WINDOW = window + 1
+    channel.CHANNEL_FILE = os.path.join(directory, 'messages.json')
+    channel.CHANNEL_JOURNAL = os.path.join(directory, 'messages.jsonl')
+    channel.CHANNEL_DATABASE = os.path.join(directory, 'messages.sqlite')
+    channel.CHANNEL_SHARED_JOURNAL = True
+    return channel.open_message_store(backend=backend)
+
+
+def post_worker(backend, directory, window, poster, texts):
+    # runs in its own process, like a WSGI worker
+    import channel
+    channel.MAIN_ROOM.store = open_backend(backend, directory, window)
+    client = channel.app.test_client()
+    headers = {'Authorization': 'authkey ' + channel.CHANNEL_AUTHKEY}
+    latencies, errors = [], 0
+    for number, text in enumerate(texts):
+        start = time.perf_counter()
+        try:
+            response = client.post('/', headers=headers,
+                                   json={'content': text, 'sender': 'poster%d' % poster,
+                                         'timestamp': '2024-01-01T00:00:00',
+                                         'extra': number})
+            errors += response.status_code != 200
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    channel.MAIN_ROOM.store.close()
+    return latencies, errors
+
+
+def bench_concurrent(backend, corpus, seed, posters=8, posts=200):
+    if multiprocessing.get_start_method(allow_none=True) is None and \
+            'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    texts = [text for _, text in corpus[:posts]]
+    # room for every message and reply, so anything missing was lost
+    window = 2 * posters * len(texts)
+    with tempfile.TemporaryDirectory() as tmp:
+        with context.Pool(posters) as pool:
+            start = time.perf_counter()
+            results = pool.starmap(post_worker, [(backend, tmp, window, poster, texts)
+                                                 for poster in range(posters)])
+            elapsed = time.perf_counter() - start
+        store = open_backend(backend, tmp, window)
+        stored = {(m['sender'], m.get('extra')) for m in store.messages()
+                  if str(m.get('sender')).startswith('poster')}
+        store.close()
+    latencies = [latency for worker, _ in results for latency in worker]
+    result = summarize(latencies, elapsed)
+    result['posters'] = posters
+    result['errors'] = sum(errors for _, errors in results)
+    result['lost'] = posters * len(texts) - len(stored)
+    return result
+
+
+def quiet_server(app):
+    """Serve app on a free localhost port from a thread, without request logs."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    # threaded, so werkzeug speaks HTTP/1.1 and keeps connections alive
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stand_in_channels(count, seed, slow_delay):
+    """A local server answering /<n>/health for count channels, some slow or failing.
+
+    Returns (server, [(endpoint, authkey, name)], listener) - the listener
+    accepts connections into its backlog but never answers (hung channels).
+    """
+    rng = random.Random(seed)
+    kinds = rng.choices(['ok', 'slow', 'error', 'dead', 'hung'],
+                        [0.86, 0.05, 0.03, 0.03, 0.03], k=count)
+
+    def app(environ, start_response):
+        number = int(environ['PATH_INFO'].split('/')[1])
+        if kinds[number] == 'slow':
+            time.sleep(slow_delay)
+        if kinds[number] == 'error':
+            start_response('500 Internal Server Error', [('Content-Type', 'text/plain')])
+            return [b'broken']
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps({'name': 'channel %d' % number}).encode()]
+
+    server = quiet_server(app)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(count)
+    with socket.socket() as closed:
+        closed.bind(('127.0.0.1', 0))
+        dead_port = closed.getsockname()[1]
+    ports = {'dead': dead_port, 'hung': listener.getsockname()[1]}
+    channels = [('http://127.0.0.1:%d/%d' % (ports.get(kind, server.server_port), number),
+                 'key', 'channel %d' % number) for number, kind in enumerate(kinds)]
+    return server, channels, listener
+
+
+def bench_health_sweep(corpus, seed, count=1000, timeout=0.5, workers=64):
+    # one hub health sweep over stand-in channels; calls are channels here
+    from health_checks import HealthChecker
+    server, channels, listener = stand_in_channels(count, seed, slow_delay=4 * timeout)
+    try:
+        checker = HealthChecker(timeout, timeout, workers)
+        start = time.perf_counter()
+        results = checker.check_all(channels)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        listener.close()
+    return {'calls': count, 'ops_per_sec': count / elapsed, 'sweep_s': elapsed,
+            'unhealthy': sum(not result.ok for result in results),
+            'sequential_s': sum(result.elapsed for result in results),
+            'slowest_timeout_s': 2 * timeout}
+
+
+def resident_kb():
+    # this process's resident memory, None where /proc isn't available
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def bench_stream_subscribers(corpus, seed, subscribers=None, extra=5, posts=200):
+    # idle /stream subscribers held open while others POST; calls are the POSTs
+    import channel
+    from message_store import MessageFeed
+    subscribers = channel.STREAM_MAX_SUBSCRIBERS if subscribers is None else subscribers
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = channel.MAIN_ROOM.store, channel.STREAM_SLOTS, channel.MAIN_ROOM.feed
+        channel.MAIN_ROOM.store = temporary_store(channel, tmp)
+        # fresh ones: the server threads of closed streams only leave at their next heartbeat
+        channel.STREAM_SLOTS = threading.BoundedSemaphore(subscribers)
+        channel.MAIN_ROOM.feed = MessageFeed()
+        server = quiet_server(channel.app)
+        sockets = []
+        try:
+            auth = 'authkey ' + channel.CHANNEL_AUTHKEY
+            threads, memory = threading.active_count(), resident_kb()
+            accepted, rejected = [], 0
+            for _ in range(subscribers + extra):
+                sock = socket.create_connection(('127.0.0.1', server.server_port))
+                sock.settimeout(5)
+                sockets.append(sock)
+                sock.sendall(('GET /stream HTTP/1.1\r\nHost: bench\r\n'
+                              'Authorization: %s\r\n\r\n' % auth).encode())
+                status = sock.recv(4096).split(b' ', 2)[1]
+                if status == b'200':
+                    accepted.append(sock)
+                else:
+                    rejected += 1
+            result_threads = threading.active_count() - threads
+            result_memory = resident_kb() - memory if memory is not None else None
+
+            session = requests.Session()
+            url = 'http://127.0.0.1:%d/' % server.server_port
+            texts = [text for _, text in corpus[:posts]]
+
+            def post(text):
+                response = session.post(url, headers={'Authorization': auth}, timeout=10,
+                                        json={'content': text, 'sender': 'bench',
+                                              'timestamp': '2024-01-01T00:00:00'})
+                if response.status_code != 200:
+                    raise RuntimeError("POST failed: %s" % response.status_code)
+
+            result = time_calls(post, [(text,) for text in texts])
+            # every subscriber should have been sent the last message
+            last = ('id: %d\n' % channel.MAIN_ROOM.messages()[-1]['id']).encode()
+            delivered = 0
+            for sock in accepted:
+                received = b''
+                try:
+                    while last not in received:
+                        chunk = sock.recv(65536)
+                        if not chunk:
+                            break
+                        received = received[-len(last):] + chunk
+                except OSError:
+                    continue
+                delivered += last in received
+            result.update({'subscribers': len(accepted), 'rejected': rejected,
+                           'delivered': delivered, 'server_threads': result_threads,
+                           'kb_per_subscriber': result_memory / max(len(accepted), 1)
+                           if result_memory is not None else None})
+            return result
+        finally:
+            for sock in sockets:
+                sock.close()
+            server.shutdown()
+            channel.MAIN_ROOM.store.close()
+            channel.MAIN_ROOM.store, channel.STREAM_SLOTS, channel.MAIN_ROOM.feed = saved
+
+
+class OneShotSessions:
+    """The client's old way: a new connection for every request."""
+
+    def get(self, url, **kwargs):
+        return requests.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return requests.post(url, **kwargs)
+
+    def stats(self):
+        return {'hosts': {}}
+
+
+def bench_client_pages(corpus, seed, channels=4, pages=2000, threads=1, pooled=True):
+    # the client's /show page, each view a GET to one of several local channel servers
+    import concurrent.futures
+    import datetime
+    import urllib.parse
+    import channel
+    import client
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = (channel.MAIN_ROOM.store, client.SESSIONS, client.CHANNELS,
+                 client.LAST_CHANNEL_UPDATE)
+        channel.MAIN_ROOM.store = temporary_store(channel, tmp)
+        servers = [quiet_server(channel.app) for _ in range(channels)]
+        try:
+            channel.MAIN_ROOM.store.append(*[{'content': text, 'sender': 'bench',
+                                              'timestamp': '2024-01-01T00:00:00'}
+                                             for _, text in corpus[:channel.CHANNEL_WINDOW]])
+            endpoints = ['http://127.0.0.1:%d' % server.server_port for server in servers]
+            client.SESSIONS = client.SessionPool(client.CLIENT_CONNECT_TIMEOUT,
+                                                 client.CLIENT_READ_TIMEOUT,
+                                                 client.CLIENT_MAX_CONNECTIONS) \
+                if pooled else OneShotSessions()
+            client.CHANNELS = [{'name': 'bench %d' % number, 'endpoint': endpoint,
+                                'authkey': channel.CHANNEL_AUTHKEY,
+                                'type_of_service': 'aiweb24:chat'}
+                               for number, endpoint in enumerate(endpoints)]
+            client.LAST_CHANNEL_UPDATE = datetime.datetime.now()
+            client.MESSAGES.clear()
+            app = client.app.test_client()
+            rng = random.Random(seed)
+            paths = ['/show?channel=' + urllib.parse.quote(rng.choice(endpoints))
+                     for _ in range(pages)]
+
+            def view(path):
+                start = time.perf_counter()
+                response = app.get(path)
+                if response.status_code != 200:
+                    raise RuntimeError("GET /show failed: %s" % response.status_code)
+                return time.perf_counter() - start
+
+            start = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+                latencies = list(pool.map(view, paths))
+            result = summarize(latencies, time.perf_counter() - start)
+            result['threads'] = threads
+            result['connections_opened'] = sum(
+                host['connections_opened'] for host in client.SESSIONS.stats()['hosts'].values()) \
+                if pooled else len(paths)
+            return result
+        finally:
+            for server in servers:
+                server.shutdown()
+            if pooled:
+                client.SESSIONS.close()
+            channel.MAIN_ROOM.store.close()
+            (channel.MAIN_ROOM.store, client.SESSIONS, client.CHANNELS,
+             client.LAST_CHANNEL_UPDATE) = saved
+
+
+BENCHMARKS = {
+    'eliza.respond': bench_respond,
+    'eliza.match_rules': bench_match_rules,
+    'eliza.match_rules.sequential': functools.partial(bench_match_rules, sequential=True),
+    'eliza.respond_many': bench_respond_many,
+    'eliza.is_keysmash': bench_keysmash,
+    'eliza.translate': bench_translate,
+    'profanity.scan': bench_profanity,
+    **{'profanity.%s.%s' % (engine, size): functools.partial(bench_profanity_size, size, scan)
+       for size in PROFANITY_SIZES
+       for engine, scan in (('scan', DEFAULT_FILTER.scan),
+                            ('better_profanity', better_profanity_scan))},
+    'channel.send_message': bench_send_message,
+    'channel.send_message_async': functools.partial(bench_send_message, replies_async=True),
+    'channel.batch': bench_batch,
+    'channel.get_messages': bench_get_messages,
+    'channel.get_messages.1000': functools.partial(bench_get_messages, window=1000),
+    'channel.get_messages.1000_gzip': functools.partial(bench_get_messages, window=1000,
+                                                        accept_gzip=True),
+    'channel.concurrent.json': functools.partial(bench_concurrent, 'json'),
+    'channel.concurrent.journal': functools.partial(bench_concurrent, 'journal'),
+    'channel.concurrent.sqlite': functools.partial(bench_concurrent, 'sqlite'),
+    'channel.stream_subscribers': bench_stream_subscribers,
+    'channel.stream_subscribers.500': functools.partial(bench_stream_subscribers, subscribers=500),
+    'hub.health_sweep': bench_health_sweep,
+    'client.show_channel': bench_client_pages,
+    'client.show_channel.unpooled': functools.partial(bench_client_pages, pooled=False),
+    'client.show_channel.threads': functools.partial(bench_client_pages, threads=8),
+    'client.show_channel.threads_unpooled': functools.partial(bench_client_pages, threads=8,
+                                                              pooled=False),
+}
+
+
+def run(names, messages, seed):
+    corpus = make_corpus(messages, seed)
+    results = {}
+    for name in names:
+        print("running %s ..." % name, file=sys.stderr)
+        # warm up caches and lazily compiled regexes first
+        BENCHMARKS[name](corpus[:200], seed)
+        results[name] = BENCHMARKS[name](corpus, seed)
+    return {'meta': {'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'messages': messages,
+                     'seed': seed,
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+def compare(report, baseline, tolerance):
+    """Return a list of regressions of report against baseline."""
+    regressions = []
+    for name, result in report['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            continue
+        for metric, higher_is_better in (('ops_per_sec', True),
+                                         ('p50_us', False), ('p99_us', False)):
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append("%s %s: %.1f -> %.1f (%+.0f%%)"
+                                   % (name, metric, old, new, change * 100))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000, help="corpus size")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS),
+                        help="run only this benchmark (repeatable)")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against this results file")
+    parser.add_argument('--save-baseline', help="write the results here as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="allowed slowdown before failing (default 0.15 = 15%%)")
+    args = parser.parse_args(argv)
+
+    report = run(args.only or list(BENCHMARKS), args.messages, args.seed)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                f.write(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line, file=sys.stderr)
+        if regressions:
+            return 1
+        print("no regressions against " + args.baseline, file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,12 +2,24 @@
 ##
 
 from flask import Flask, request, render_template, jsonify
+import click
+import gzip
 import json
+import os
 import requests
+import threading
+import time
 # own imports
-from better_profanity import profanity
 from datetime import datetime
-from eliza import Eliza
+from eliza import Eliza, DEFAULT_RULES, RuleStats, StageTimings, Utterance, measure_construction_cost
+from profanity_filter import DEFAULT_FILTER
+from rule_pack import RuleSetReloader, dump_pack
+from message_store import MessageStore, SQLiteStore
+from archive import Archive
+from rooms import Room, RoomRegistry
+from reply_queue import ReplyQueue
+from per_process import PerProcess
+from encoded_window import json_bytes
 
 # Class-based application configuration
 class ConfigClass(object):
@@ -26,101 +38,470 @@ HUB_AUTHKEY = 'Crr-K24d-2N'
 CHANNEL_AUTHKEY = '0987654321' 
 CHANNEL_NAME = "Group Therapy with Eliza"
 CHANNEL_ENDPOINT = "http://vm146.rz.uni-osnabrueck.de/u032/channel.wsgi/" # don't forget to adjust in the bottom of the file
-CHANNEL_FILE = 'messages.json'
+CHANNEL_FILE = 'messages.json' # old message file, imported into the journal once
+CHANNEL_JOURNAL = 'messages.jsonl'
+CHANNEL_WINDOW = 25 # messages shown, including the welcome message
+CHANNEL_BACKEND = 'journal' # or 'sqlite' when several worker processes serve the channel
+CHANNEL_SHARED_JOURNAL = False # several processes on the journal, slower than 'sqlite'
+CHANNEL_DATABASE = 'messages.sqlite'
 CHANNEL_TYPE_OF_SERVICE = 'aiweb24:chat'
+CHANNEL_HEARTBEAT = None # seconds between heartbeats pushed to the hub, None to be polled by the hub
+CHANNEL_MAX_AGE = None # seconds a message stays in the window, None to keep it until it's pushed out
+CHANNEL_MAX_BYTES = None # most bytes of JSON in the window
+CHANNEL_ARCHIVE = None # directory keeping evicted messages as compressed segments, None to drop them
+CHANNEL_ARCHIVE_SEGMENT = 1 << 20 # bytes per archive segment
+CHANNEL_ARCHIVE_SEGMENTS = None # segments kept, the oldest are deleted; None to keep all
+# more rooms served under /<slug>/, each registered with the hub as its own channel, e.g.
+# {'anxiety': {'name': "Anxiety Group with Eliza", 'authkey': '...', 'window': 25}}
+# ('max_age' and 'max_bytes' override the channel's limits)
+CHANNEL_ROOMS = {}
+CHANNEL_ROOM_IDLE = 600 # seconds until an unused room's messages are unloaded from memory
+CHANNEL_BATCH_LIMIT = 10000 # most messages accepted by one POST /batch
+CHANNEL_GZIP_MIN_SIZE = 1024 # smallest GET body sent gzip-compressed to clients accepting it, None for never
+CHANNEL_GZIP_LEVEL = 6
+STREAM_HEARTBEAT = 15 # seconds between keep-alive comments on idle /stream connections
+STREAM_POLL = 2 # seconds between checks for messages other worker processes stored
+CHANNEL_THREADS = 15 # server threads per worker process, as in mod_wsgi's WSGIDaemonProcess threads=
+CHANNEL_GREENLETS = False # True when served by gevent/eventlet workers (gunicorn -k gevent), one greenlet per connection
+STREAM_MAX_SUBSCRIBERS = 10 # /stream connections per process, all rooms together; with threads each one holds
+                            # one of the CHANNEL_THREADS while connected, so at most CHANNEL_THREADS - 1 are let in
+ELIZA_PROFILE = False # time Eliza's stages and count rule hits, see GET /stats
+ELIZA_CACHE_SIZE = 1024 # remembered rule matches for repeated messages
+ELIZA_RULE_PACK = None # JSON/YAML rules to use instead of the built-in ones, reloaded when changed
+ELIZA_ASYNC = False # store a message and return, Eliza answers from a background worker
+ELIZA_WORKERS = 2
+ELIZA_QUEUE_SIZE = 1000 # messages waiting for an answer; when full, posters wait for theirs
+ELIZA_BATCH = 32 # most queued messages answered together
+
+ELIZA_TIMINGS = StageTimings()
+ELIZA_RULE_STATS = RuleStats(DEFAULT_RULES)
+DEFAULT_RULES.cache.resize(ELIZA_CACHE_SIZE)
+# load the rule pack now, so pre-forked workers share the compiled rules
+RULE_PACK = RuleSetReloader(ELIZA_RULE_PACK, ELIZA_CACHE_SIZE) if ELIZA_RULE_PACK else None
+
+def current_rules():
+    # the built-in rules, or the latest version of the rule pack
+    if RULE_PACK is None:
+        return DEFAULT_RULES
+    return RULE_PACK.current()
+
+def rule_stats(rules):
+    # rule counters belong to one rule set, start over when it changes
+    global ELIZA_RULE_STATS
+    if ELIZA_RULE_STATS.rules is not rules:
+        ELIZA_RULE_STATS = RuleStats(rules)
+    return ELIZA_RULE_STATS
+
+def welcome_message():
+    return {'content': "Welcome to the group therapy channel. I am the therapist Eliza.",
+            'sender': "Eliza",
+            'timestamp': datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+            }
+
+def room_file(path, room):
+    # messages.jsonl is the main room's, messages-<slug>.jsonl another room's
+    if room is None or not room.slug:
+        return path
+    base, extension = os.path.splitext(path)
+    return base + '-' + room.slug + extension
+
+def open_archive(room=None):
+    if not CHANNEL_ARCHIVE:
+        return None
+    return Archive(room_file(CHANNEL_ARCHIVE, room), CHANNEL_ARCHIVE_SEGMENT,
+                   CHANNEL_ARCHIVE_SEGMENTS)
+
+def open_message_store(room=None, backend=None):
+    # nothing is read until the first request
+    backend = backend or CHANNEL_BACKEND
+    window = (room.window if room else CHANNEL_WINDOW) - 1
+    legacy_file = CHANNEL_FILE if room is None or not room.slug else None
+    config = CHANNEL_ROOMS.get(room.slug, {}) if room else {}
+    limits = {'max_age': config.get('max_age', CHANNEL_MAX_AGE),
+              'max_bytes': config.get('max_bytes', CHANNEL_MAX_BYTES),
+              'archive': open_archive(room)}
+    if backend == 'sqlite':
+        return SQLiteStore(room_file(CHANNEL_DATABASE, room), window=window,
+                           welcome=welcome_message, legacy_file=legacy_file, **limits)
+    if backend == 'journal':
+        return MessageStore(room_file(CHANNEL_JOURNAL, room), window=window,
+                            welcome=welcome_message, legacy_file=legacy_file,
+                            shared=CHANNEL_SHARED_JOURNAL, **limits)
+    raise ValueError("Unknown message backend: " + backend)
+
+ROOMS = RoomRegistry(CHANNEL_ROOM_IDLE)
+if CHANNEL_GREENLETS:
+    STREAM_SLOTS = threading.BoundedSemaphore(STREAM_MAX_SUBSCRIBERS)
+else:
+    # never more subscribers than threads minus one, or open streams leave nothing for POST and GET
+    STREAM_SLOTS = threading.BoundedSemaphore(max(0, min(STREAM_MAX_SUBSCRIBERS, CHANNEL_THREADS - 1)))
+MAIN_ROOM = ROOMS.add(Room('', CHANNEL_NAME, CHANNEL_AUTHKEY, CHANNEL_ENDPOINT, open_message_store,
+                           CHANNEL_WINDOW))
+for slug, config in CHANNEL_ROOMS.items():
+    ROOMS.add(Room(slug, config['name'], config['authkey'],
+                   config.get('endpoint', CHANNEL_ENDPOINT.rstrip('/') + '/' + slug + '/'),
+                   open_message_store, config.get('window', CHANNEL_WINDOW)))
+
+def find_room(slug):
+    # the room a request is for, the main room without a prefix
+    return ROOMS.get(slug or '')
 
 @app.cli.command('register')
 def register_command():
-    global CHANNEL_AUTHKEY, CHANNEL_NAME, CHANNEL_ENDPOINT
+    # every room is a channel of its own on the hub
+    for room in ROOMS:
+        # send a POST request to server /channels
+        response = requests.post(HUB_URL + '/channels', headers={'Authorization': 'authkey ' + HUB_AUTHKEY},
+                                 data=json.dumps({
+                                    "name": room.name,
+                                    "endpoint": room.endpoint,
+                                    "authkey": room.authkey,
+                                    "type_of_service": CHANNEL_TYPE_OF_SERVICE,
+                                 }))
+
+        if response.status_code != 200:
+            print("Error creating channel "+room.name+": "+str(response.status_code))
+            print(response.text)
 
-    # send a POST request to server /channels
-    response = requests.post(HUB_URL + '/channels', headers={'Authorization': 'authkey ' + HUB_AUTHKEY},
-                             data=json.dumps({
-                                "name": CHANNEL_NAME,
-                                "endpoint": CHANNEL_ENDPOINT,
-                                "authkey": CHANNEL_AUTHKEY,
-                                "type_of_service": CHANNEL_TYPE_OF_SERVICE,
-                             }))
+def heartbeat_records():
+    return [{'endpoint': room.endpoint, 'authkey': room.authkey} for room in ROOMS]
 
+def send_heartbeats():
+    # one POST for all rooms; True if the hub took it
+    try:
+        response = requests.post(HUB_URL + '/heartbeat', headers={'Authorization': 'authkey ' + HUB_AUTHKEY},
+                                 json={'heartbeats': heartbeat_records()}, timeout=(2, 5))
+    except requests.exceptions.RequestException as e:
+        print(f"Could not send heartbeats: {e}")
+        return False
     if response.status_code != 200:
-        print("Error creating channel: "+str(response.status_code))
+        print("Error sending heartbeats: "+str(response.status_code))
         print(response.text)
-        return
+        return False
+    for endpoint in response.json().get('unknown', []):
+        print("The hub doesn't know "+endpoint+", run flask --app channel.py register")
+    for endpoint in response.json().get('unauthorized', []):
+        print("The hub has another authkey for "+endpoint+", register it again")
+    return True
+
+def spawn_heartbeats():
+    thread = threading.Thread(target=heartbeat_loop, daemon=True, name='heartbeat')
+    thread.start()
+    return thread
+
+HEARTBEAT_THREAD = PerProcess(spawn_heartbeats)
+
+def start_heartbeats():
+    # threads don't survive a fork, start one in the process that serves
+    if CHANNEL_HEARTBEAT:
+        HEARTBEAT_THREAD.get()
+
+def heartbeat_loop(interval=None):
+    while True:
+        try:
+            send_heartbeats()
+        except Exception as e:
+            # e.g. a reply that isn't the JSON we expect; keep the thread alive
+            print(f"Could not send heartbeats: {e}")
+        time.sleep(interval or CHANNEL_HEARTBEAT)
+
+@app.before_request
+def before_request():
+    start_heartbeats()
+
+@app.cli.command('heartbeat')
+@click.option('--every', type=float, default=None, help="keep sending, every this many seconds")
+def heartbeat_command(every):
+    # tell the hub the rooms are alive, once or (e.g. next to a WSGI server) periodically
+    if every:
+        heartbeat_loop(every)
+    elif not send_heartbeats():
+        raise SystemExit(1)
+
+@app.cli.command('construction_cost')
+def construction_cost_command():
+    # how much building Eliza per request used to cost compared to now
+    cost = measure_construction_cost()
+    print("Rebuilding the rule set: %.1f us" % cost['rebuild_us'])
+    print("Eliza() on the shared rule set: %.1f us" % cost['shared_us'])
+    print("Saved per request: %.1f us" % cost['saved_us'])
+
+@app.cli.command('export_rules')
+@click.argument('path')
+def export_rules_command(path):
+    # write the built-in rules as a rule pack to start editing from
+    dump_pack(path)
+    print("Wrote the built-in rules to " + path)
+
+@app.cli.command('read_archive')
+@click.argument('room', default='')
+@click.option('--since', type=int, default=None, help="only messages with a higher id")
+def read_archive_command(room, since):
+    # print a room's archived messages as JSON lines, oldest first
+    found = find_room(room)
+    if found is None:
+        raise click.BadParameter("Unknown room " + room)
+    archive = open_archive(found)
+    if archive is None:
+        raise click.UsageError("CHANNEL_ARCHIVE is not set")
+    for message in archive.read(since):
+        print(json.dumps(message))
 
-def check_authorization(request):
+def check_authorization(request, room=None):
     global CHANNEL_AUTHKEY
+    authkey = room.authkey if room else CHANNEL_AUTHKEY
     # check if Authorization header is present
     if 'Authorization' not in request.headers:
         return False
     # check if authorization header is valid
-    if request.headers['Authorization'] != 'authkey ' + CHANNEL_AUTHKEY:
+    if request.headers['Authorization'] != 'authkey ' + authkey:
         return False
     return True
 
 @app.route('/health', methods=['GET'])
-def health_check():
-    global CHANNEL_NAME
-    if not check_authorization(request):
+@app.route('/<room>/health', methods=['GET'])
+def health_check(room=None):
+    room = find_room(room)
+    if room is None:
+        return "Unknown room", 404
+    if not check_authorization(request, room):
         return "Invalid authorization", 400
-    return jsonify({'name':CHANNEL_NAME}),  200
+    return jsonify({'name':room.name}),  200
 
-# GET: Return list of messages
+# GET: Return where Eliza's reply time goes and which rules fire
+@app.route('/stats', methods=['GET'])
+@app.route('/<room>/stats', methods=['GET'])
+def eliza_stats(room=None):
+    room = find_room(room)
+    if room is None:
+        return "Unknown room", 404
+    if not check_authorization(request, room):
+        return "Invalid authorization", 400
+    rules = current_rules()
+    return jsonify({'profiling': ELIZA_PROFILE,
+                    'timings': ELIZA_TIMINGS.as_dict(),
+                    'rules': rule_stats(rules).as_dict(),
+                    'cache': rules.cache.stats(),
+                    'rule_pack': None if RULE_PACK is None else
+                                 {'path': RULE_PACK.path,
+                                  'reloads': RULE_PACK.reloads,
+                                  'last_error': RULE_PACK.last_error},
+                    'messages': room.stats(),
+                    'stream_subscribers': room.feed.subscribers,
+                    'rooms': {'count': len(ROOMS), 'loaded': ROOMS.loaded()},
+                    'replies': REPLIES.stats() if ELIZA_ASYNC else None}), 200
+
+# GET: Return list of messages, ?since=<id> for only the newer ones
 @app.route('/', methods=['GET'])
-def home_page():
-    if not check_authorization(request):
+@app.route('/<room>/', methods=['GET'])
+def home_page(room=None):
+    room = find_room(room)
+    if room is None:
+        return "Unknown room", 404
+    if not check_authorization(request, room):
         return "Invalid authorization", 400
-    # fetch channels from server
-    return jsonify(read_messages())
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return "Invalid since", 400
+    # encoded once per change of the window, not per request
+    window = room.encoded(encode_message, CHANNEL_GZIP_LEVEL)
+    body = window.since(since)
+    compress = (CHANNEL_GZIP_MIN_SIZE is not None and len(body) >= CHANNEL_GZIP_MIN_SIZE
+                and request.accept_encodings['gzip'] > 0)
+    # the compressed body is another representation, with a tag of its own
+    etag = window.etag + '-gzip' if compress else window.etag
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    elif compress:
+        response = app.response_class(window.gzipped() if since is None
+                                      else gzip.compress(body, CHANNEL_GZIP_LEVEL),
+                                      mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    return response
+
+# GET: Server-sent events, one per new message; resumes after Last-Event-ID
+@app.route('/stream', methods=['GET'])
+@app.route('/<room>/stream', methods=['GET'])
+def stream_messages(room=None):
+    room = find_room(room)
+    if room is None:
+        return "Unknown room", 404
+    if not check_authorization(request, room):
+        return "Invalid authorization", 400
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return "Invalid Last-Event-ID", 400
+    slots = STREAM_SLOTS
+    if not slots.acquire(blocking=False):
+        return "Too many subscribers", 503
+    room.feed.join()
+    response = app.response_class(stream_events(room, since), mimetype='text/event-stream',
+                                  headers={'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no'})
+    response.call_on_close(room.feed.leave)
+    response.call_on_close(slots.release)
+    return response
+
+def stream_events(room, since):
+    # without since, start with the whole window like GET /
+    shared = CHANNEL_BACKEND == 'sqlite' or CHANNEL_SHARED_JOURNAL
+    yield "retry: 3000\n\n"
+    quiet_since = time.monotonic()
+    while True:
+        messages = room.messages()
+        if since is not None and messages[-1]['id'] < since:
+            since = None # the store was reset, start over
+        new = messages if since is None else messages_since(messages, since)
+        if new:
+            yield ''.join("id: %d\nevent: message\ndata: %s\n\n" % (m['id'], json.dumps(m))
+                          for m in new)
+            since = new[-1]['id']
+            quiet_since = time.monotonic()
+        # other processes don't wake us up, check back every STREAM_POLL seconds
+        timeout = min(STREAM_HEARTBEAT, STREAM_POLL) if shared else STREAM_HEARTBEAT
+        if not room.feed.wait(since, timeout) and time.monotonic() - quiet_since >= STREAM_HEARTBEAT:
+            # keeps proxies from closing the connection, and finds clients that left
+            yield ": heartbeat\n\n"
+            quiet_since = time.monotonic()
 
 # POST: Send a message
 @app.route('/', methods=['POST'])
-def send_message():
-    # fetch channels from server
+@app.route('/<room>/', methods=['POST'])
+def send_message(room=None):
+    room = find_room(room)
+    if room is None:
+        return "Unknown room", 404
     # check authorization header
-    if not check_authorization(request):
+    if not check_authorization(request, room):
         return "Invalid authorization", 400
     # check if message is present
     message = request.json
+    error = message_error(message)
+    if error:
+        return error, 400
+    # normalize once, one profanity pass serves both Eliza and the filter
+    utterance = Utterance(message['content'])
+    scan = DEFAULT_FILTER.scan(utterance.text, utterance.lowered)
+    stored_msg = filtered_message(message, scan)
+    if ELIZA_ASYNC:
+        room.append(stored_msg)
+        # answered by a worker, or right here if the queue is full
+        if REPLIES.submit((room, message, scan.profane, utterance)):
+            return "OK", 200
+        room.append(answer_message(message, scan.profane, utterance))
+        return "OK", 200
+    # answer
+    answer_msg = answer_message(message, scan.profane, utterance)
+    # add message and answer with one append, the window drops the oldest
+    room.append(stored_msg,
+                {'content': answer_msg['content'],
+                 'sender': answer_msg['sender'],
+                 'timestamp': answer_msg['timestamp'],
+                 })
+
+    return "OK", 200
+
+# POST: Send many messages at once, e.g. from a bridge or a replay
+@app.route('/batch', methods=['POST'])
+@app.route('/<room>/batch', methods=['POST'])
+def send_batch(room=None):
+    room = find_room(room)
+    if room is None:
+        return "Unknown room", 404
+    if not check_authorization(request, room):
+        return "Invalid authorization", 400
+    batch = request.json
+    if isinstance(batch, dict):
+        batch = batch.get('messages')
+    if not isinstance(batch, list):
+        return "No messages", 400
+    if len(batch) > CHANNEL_BATCH_LIMIT:
+        return "Too many messages, at most %d" % CHANNEL_BATCH_LIMIT, 413
+    status = []
+    accepted = [] # (position in batch, message, utterance, scan)
+    scanned = {} # content -> (utterance, scan), repeated texts are checked once
+    for message in batch:
+        error = message_error(message) if isinstance(message, dict) else "No message"
+        status.append({'status': 'error', 'error': error} if error else {'status': 'ok'})
+        if not error:
+            content = message['content']
+            if content not in scanned:
+                utterance = Utterance(content)
+                scanned[content] = utterance, DEFAULT_FILTER.scan(utterance.text, utterance.lowered)
+            accepted.append((len(status) - 1, message) + scanned[content])
+    if accepted:
+        # one respond_many for the replies, one append for everything
+        replies = therapist().respond_many([utterance for _, _, utterance, _ in accepted],
+                                           [message['sender'] for _, message, _, _ in accepted],
+                                           profane=[scan.profane for _, _, _, scan in accepted])
+        stored = room.append(*[stored
+                                   for (_, message, _, scan), reply in zip(accepted, replies)
+                                   for stored in (filtered_message(message, scan),
+                                                  eliza_message(reply))])
+        for number, (position, _, _, _) in enumerate(accepted):
+            status[position]['id'] = stored[2 * number]['id']
+            status[position]['reply_id'] = stored[2 * number + 1]['id']
+    return jsonify({'accepted': len(accepted),
+                    'rejected': len(batch) - len(accepted),
+                    'status': status}), 200
+
+def message_error(message):
+    # what is missing from a posted message, None if nothing
     if not message:
-        return "No message", 400
+        return "No message"
     if not 'content' in message:
-        return "No content", 400
+        return "No content"
+    if not isinstance(message['content'], str):
+        return "Content must be text"
     if not 'sender' in message:
-        return "No sender", 400
+        return "No sender"
     if not 'timestamp' in message:
-        return "No timestamp", 400
-    if not 'extra' in message:
-        extra = None
-    else:
-        extra = message['extra']
-    # answer
-    answer_msg = answer_message(message)
-    # filter
-    message['content'] = profanity.censor(message['content']) 
-    # add message to messages
-    messages = read_messages()
-    messages.append({'content': message['content'],
-                     'sender': message['sender'],
-                     'timestamp': message['timestamp'],
-                     'extra': extra,
-                     })
-    # check overflow
-    messages = check_msg_overflow(messages)
-    save_messages(messages)
-
-    # add message to messages
-    messages = read_messages()
-    messages.append({'content': answer_msg['content'],
-                     'sender': answer_msg['sender'],
-                     'timestamp': answer_msg['timestamp'],
-                     })
-    save_messages(messages)
+        return "No timestamp"
+    return None
 
-    return "OK", 200
+def filtered_message(message, scan):
+    # the message as stored: censored, with the fields the channel keeps
+    return {'content': scan.censored,
+            'sender': message['sender'],
+            'timestamp': message['timestamp'],
+            'extra': message.get('extra'),
+            }
+
+def therapist():
+    rules = current_rules() # compiled once per process (and per pack change)
+    if ELIZA_PROFILE:
+        return Eliza(rules, timings=ELIZA_TIMINGS, stats=rule_stats(rules))
+    return Eliza(rules)
+
+def answer_message(msg, profane=None, utterance=None):
+    reply = therapist().respond(utterance or msg['content'], msg['sender'], profane=profane)
+    return eliza_message(reply)
+
+def answer_queued(batch):
+    # answer (room, message, profane, utterance) items from the reply queue together
+    replies = therapist().respond_many([utterance for _, _, _, utterance in batch],
+                                       [msg['sender'] for _, msg, _, _ in batch],
+                                       profane=[profane for _, _, profane, _ in batch])
+    # one append per room
+    by_room = {}
+    for (room, _, _, _), reply in zip(batch, replies):
+        by_room.setdefault(room, []).append(eliza_message(reply))
+    for room, messages in by_room.items():
+        room.append(*messages)
+
+REPLIES = ReplyQueue(answer_queued, ELIZA_WORKERS, ELIZA_QUEUE_SIZE, ELIZA_BATCH)
 
-def answer_message(msg):
-    therapist = Eliza()
-    reply = therapist.respond(msg['content'], msg['sender'])
+def eliza_message(reply):
     new_msg = {'content': reply,
                 'sender': "Eliza",
                 'timestamp': datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
@@ -132,42 +513,18 @@ def answer_message(msg):
                 }
     return new_msg
 
-def check_msg_overflow(messages, cap=25):
-    # delete old messages if cap of messages is reached
-    if len(messages) > cap:
-        messages.remove(messages[1]) # del 2nd msg (first is welcome msg and should stay!)
-        messages.remove(messages[2]) # del 3rd msg (make space for answer msg)
-    return messages
-
-def welcome(messages):
-    # in case message file is empty send welcome message
-    if len(messages) == 0:
-        new_msg = {'content': "Welcome to the group therapy channel. I am the therapist Eliza.",
-            'sender': "Eliza",
-            'timestamp': datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
-                }
-        messages.append(new_msg)
-    return messages
+def encode_message(message):
+    return json_bytes(app, message)
+
+def messages_since(messages, since):
+    # the messages with an id above since, scanning back from the newest
+    start = len(messages)
+    while start > 0 and messages[start - 1]['id'] > since:
+        start -= 1
+    return messages[start:]
 
 def read_messages():
-    global CHANNEL_FILE
-    try:
-        f = open(CHANNEL_FILE, 'r')
-    except FileNotFoundError:
-        return []
-    try:
-        messages = json.load(f)
-    except json.decoder.JSONDecodeError:
-        messages = []
-    f.close()
-    # in case message file is empty
-    messages = welcome(messages)
-    return messages
-
-def save_messages(messages):
-    global CHANNEL_FILE
-    with open(CHANNEL_FILE, 'w') as f:
-        json.dump(messages, f)
+    return MAIN_ROOM.messages()
 
 # Start development web server
 # run flask --app channel.py register
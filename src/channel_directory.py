@@ -0,0 +1,80 @@
+"""
+channel_directory.py - the hub's list of active channels, kept ready to send
+
+Every client asks the hub for its channels, and the hub used to query
+and serialize them for each request.  ChannelDirectory keeps the active
+channels and their JSON body in memory.  It reads the table again only
+after invalidate() (the hub calls it when a registration or a health
+check changed which channels are active) or, for changes made by other
+processes, once the snapshot is older than ttl seconds.
+
+The snapshot's version only grows when the listed channels actually
+changed; its etag is a digest of the body, so every hub process gives
+the same content the same tag.
+"""
+
+import hashlib
+import threading
+import time
+from collections import namedtuple
+
+# channels: the rows for templates; ids: the active channels' ids
+Snapshot = namedtuple('Snapshot', 'version etag body channels ids')
+
+# what GET /channels shows of a channel
+PUBLIC_FIELDS = ('name', 'endpoint', 'authkey', 'type_of_service')
+
+
+class ChannelDirectory:
+    def __init__(self, load, encode, ttl=5.0):
+        """load: returns the active channels as dicts, ordered by id
+        encode: turns the response (a dict) into bytes of JSON
+        """
+        self.load = load
+        self.encode = encode
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.snapshot = Snapshot(0, None, None, [], frozenset())
+        self.expires = 0.0     # time.monotonic() when the snapshot must be checked again
+        self.invalidations = 0
+        self.reloads = 0
+
+    def current(self):
+        """The snapshot, read again first if it was invalidated or is too old."""
+        if time.monotonic() < self.expires:
+            return self.snapshot
+        with self.lock:
+            if time.monotonic() >= self.expires:  # another thread may have just reloaded
+                self._reload()
+            return self.snapshot
+
+    def invalidate(self):
+        self.invalidations += 1
+        self.expires = 0.0
+
+    def affected_by(self, active_ids, inactive_ids):
+        """Invalidate if channels became active or inactive."""
+        ids = self.snapshot.ids
+        if any(id not in ids for id in active_ids) or any(id in ids for id in inactive_ids):
+            self.invalidate()
+
+    def stats(self):
+        return {'version': self.snapshot.version,
+                'channels': len(self.snapshot.ids),
+                'reloads': self.reloads}
+
+    def _reload(self):
+        invalidations = self.invalidations
+        channels = self.load()
+        body = self.encode({'channels': [{field: channel[field] for field in PUBLIC_FIELDS}
+                                         for channel in channels]})
+        etag = hashlib.sha1(body).hexdigest()[:16]
+        version = self.snapshot.version
+        if etag != self.snapshot.etag:
+            version += 1
+        # the rows are replaced anyway, they carry e.g. last_heartbeat for the home page
+        self.snapshot = Snapshot(version, etag, body, channels,
+                                 frozenset(channel['id'] for channel in channels))
+        if invalidations == self.invalidations:  # else read again next time
+            self.expires = time.monotonic() + self.ttl
+        self.reloads += 1
@@ -1,29 +1,49 @@
-from flask import Flask, request, render_template, url_for, redirect
+from flask import Flask, request, render_template, url_for, redirect, jsonify
 import requests
 import urllib.parse
 import datetime
 
+from http_sessions import SessionPool
+
 app = Flask(__name__)
 
 HUB_AUTHKEY = '1234567890'
 HUB_URL = 'http://localhost:5555'
+CLIENT_CONNECT_TIMEOUT = 2 # seconds to connect to the hub or a channel
+CLIENT_READ_TIMEOUT = 10 # seconds to wait for their answer
+CLIENT_MAX_CONNECTIONS = 16 # idle connections kept per host, about the number of server threads
 
 CHANNELS = None
 LAST_CHANNEL_UPDATE = None
+CHANNELS_ETAG = None # of the hub's last channel list, to ask for changes only
+MESSAGES = {} # channel endpoint -> (ETag, messages) of the last fetch
+
+# kept-alive connections to the hub and the channels, shared by all threads
+SESSIONS = SessionPool(CLIENT_CONNECT_TIMEOUT, CLIENT_READ_TIMEOUT, CLIENT_MAX_CONNECTIONS)
 
 
 def update_channels():
-    global CHANNELS, LAST_CHANNEL_UPDATE
+    global CHANNELS, LAST_CHANNEL_UPDATE, CHANNELS_ETAG
     if CHANNELS and LAST_CHANNEL_UPDATE and (datetime.datetime.now() - LAST_CHANNEL_UPDATE).seconds < 60:
         return CHANNELS
     # fetch list of channels from server
-    response = requests.get(HUB_URL + '/channels', headers={'Authorization': 'authkey ' + HUB_AUTHKEY})
+    headers = {'Authorization': 'authkey ' + HUB_AUTHKEY}
+    if CHANNELS and CHANNELS_ETAG:
+        headers['If-None-Match'] = CHANNELS_ETAG
+    try:
+        response = SESSIONS.get(HUB_URL + '/channels', headers=headers)
+    except requests.exceptions.RequestException as e:
+        return "Error fetching channels: "+str(e), 400
+    if response.status_code == 304:
+        LAST_CHANNEL_UPDATE = datetime.datetime.now()
+        return CHANNELS
     if response.status_code != 200:
         return "Error fetching channels: "+str(response.text), 400
     channels_response = response.json()
     if not 'channels' in channels_response:
         return "No channels in response", 400
     CHANNELS = channels_response['channels']
+    CHANNELS_ETAG = response.headers.get('ETag')
     LAST_CHANNEL_UPDATE = datetime.datetime.now()
     return CHANNELS
 
@@ -47,11 +67,30 @@ def show_channel():
             break
     if not channel:
         return "Channel not found", 404
-    response = requests.get(channel['endpoint'], headers={'Authorization': 'authkey ' + channel['authkey']})
+    messages, error = fetch_messages(channel)
+    if error is not None:
+        return "Error fetching messages: "+str(error), 400
+    return render_template("channel.html", channel=channel, messages=messages)
+
+
+def fetch_messages(channel):
+    # ask the channel whether anything changed since the last fetch (304 if not)
+    headers = {'Authorization': 'authkey ' + channel['authkey']}
+    cached = MESSAGES.get(channel['endpoint'])
+    if cached:
+        headers['If-None-Match'] = cached[0]
+    try:
+        response = SESSIONS.get(channel['endpoint'], headers=headers)
+    except requests.exceptions.RequestException as e:
+        return None, str(e)
+    if response.status_code == 304 and cached:
+        return cached[1], None
     if response.status_code != 200:
-        return "Error fetching messages: "+str(response.text), 400
+        return None, response.text
     messages = response.json()
-    return render_template("channel.html", channel=channel, messages=messages)
+    if 'ETag' in response.headers:
+        MESSAGES[channel['endpoint']] = (response.headers['ETag'], messages)
+    return messages, None
 
 
 @app.route('/post', methods=['POST'])
@@ -70,14 +109,23 @@ def post_message():
     message_content = request.form['content']
     message_sender = request.form['sender']
     message_timestamp = datetime.datetime.now().isoformat()
-    response = requests.post(channel['endpoint'],
-                             headers={'Authorization': 'authkey ' + channel['authkey']},
-                             json={'content': message_content, 'sender': message_sender, 'timestamp': message_timestamp})
+    try:
+        response = SESSIONS.post(channel['endpoint'],
+                                 headers={'Authorization': 'authkey ' + channel['authkey']},
+                                 json={'content': message_content, 'sender': message_sender, 'timestamp': message_timestamp})
+    except requests.exceptions.RequestException as e:
+        return "Error posting message: "+str(e), 400
     if response.status_code != 200:
         return "Error posting message: "+str(response.text), 400
     return redirect(url_for('show_channel')+'?channel='+urllib.parse.quote(post_channel))
 
 
+@app.route('/stats')
+def client_stats():
+    # usage of the connection pools, per upstream host
+    return jsonify(SESSIONS.stats())
+
+
 # Start development web server
 if __name__ == '__main__':
     app.run(port=5005, debug=True)
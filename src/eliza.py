@@ -18,20 +18,72 @@ Copyright (c) 2002-2020 JezUK Ltd, Joe Strout, Jeff Epler
 import string
 import re
 import random
-from better_profanity import profanity
+import time
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from profanity_filter import DEFAULT_FILTER
+
+#----------------------------------------------------------------------
+# Utterance: a message normalized once for all of Eliza's checks:
+#  the lowercased text, its words (as a list and a set) and counts of
+#  ASCII letters, vowels, digits and whitespace.
+#----------------------------------------------------------------------
+_SPLIT_PUNCTUATION = str.maketrans(string.punctuation.replace("'", ''),
+                                   ' ' * (len(string.punctuation) - 1))
+_LETTERS, _VOWELS = string.ascii_letters, 'aeiou'
+_DIGITS, _SPACES = string.digits, string.whitespace
+_DROP = {chars: str.maketrans('', '', chars)
+         for chars in (_LETTERS, _VOWELS, _DIGITS, _SPACES)}
+_DROP_BYTES = {chars: chars.encode() for chars in _DROP}
+
+class Utterance:
+  __slots__ = ('text', 'lowered', 'tokens', 'token_set', 'length',
+               'letters', 'vowels', 'digits', 'spaces')
+
+  def __init__(self, text):
+    self.text = text
+    self.lowered = lowered = text.lower()
+    self.tokens = lowered.translate(_SPLIT_PUNCTUATION).split()
+    self.token_set = frozenset(self.tokens)
+    self.length = length = len(text)
+    if text.isascii():
+      # bytes.translate is a lot quicker at dropping characters
+      raw, raw_lowered = text.encode(), lowered.encode()
+      self.letters = length - len(raw.translate(None, _DROP_BYTES[_LETTERS]))
+      self.vowels = length - len(raw_lowered.translate(None, _DROP_BYTES[_VOWELS]))
+      self.digits = length - len(raw.translate(None, _DROP_BYTES[_DIGITS]))
+      self.spaces = length - len(raw.translate(None, _DROP_BYTES[_SPACES]))
+    else:
+      self.letters = length - len(text.translate(_DROP[_LETTERS]))
+      self.vowels = len(lowered) - len(lowered.translate(_DROP[_VOWELS]))
+      self.digits = length - len(text.translate(_DROP[_DIGITS]))
+      self.spaces = length - len(text.translate(_DROP[_SPACES]))
+
+
+GREETINGS = frozenset(("hi", "hey", "hello", "hallo"))
+
+def is_greeting(text):
+  if not isinstance(text, Utterance):
+    text = Utterance(text)
+  return not text.token_set.isdisjoint(GREETINGS)
 
 def is_keysmash(text):
     # Keysmashes are long, have few vowels, and are not real words
-    if len(text) < 6:  # Too short to be a keysmash
+    if not isinstance(text, Utterance):
+        if len(text) < 6:  # Too short to be a keysmash
+            return False
+        text = Utterance(text)
+    if text.length < 6:  # Too short to be a keysmash
         return False
-    
-    # Check if text is mostly lowercase letters
-    if not re.fullmatch(r"[a-zA-Z]+", text):
+
+    # Check if text is only letters
+    if text.letters != text.length:
         return False  # Contains numbers or symbols, probably not a keysmash
     
     # Count vowels and consonants
-    vowels = sum(1 for char in text.lower() if char in "aeiou")
-    consonants = len(text) - vowels
+    vowels = text.vowels
+    consonants = text.length - vowels
     
     # Heuristic: Keysmashes usually have very few vowels
     if vowels / max(consonants, 1) < 0.3:  # Less than 30% vowels
@@ -40,10 +92,469 @@ def is_keysmash(text):
     return False
 
 
-class Eliza:
+#----------------------------------------------------------------------
+# StageTimings: where Eliza's reply time goes.  Cumulative seconds and
+#  number of runs for each stage of classify; shared between threads.
+#----------------------------------------------------------------------
+class StageTimings:
+  STAGES = ('normalize', 'profanity', 'greeting', 'keysmash', 'rules')
+
   def __init__(self):
-    self.keys = list(map(lambda x: re.compile(x[0], re.IGNORECASE), gPats))
-    self.values = list(map(lambda x: x[1], gPats))
+    self.lock = threading.Lock()
+    self.messages = 0
+    self.runs = dict.fromkeys(self.STAGES, 0)
+    self.seconds = dict.fromkeys(self.STAGES, 0.0)
+
+  def record(self, spent):
+    # spent: seconds for the first len(spent) stages (later ones didn't run)
+    with self.lock:
+      self.messages += 1
+      for stage, seconds in zip(self.STAGES, spent):
+        self.runs[stage] += 1
+        self.seconds[stage] += seconds
+
+  def as_dict(self):
+    with self.lock:
+      return {'messages': self.messages,
+              'stages': {stage: {'runs': self.runs[stage],
+                                 'total_ms': self.seconds[stage] * 1e3,
+                                 'mean_us': self.seconds[stage] / max(self.runs[stage], 1) * 1e6}
+                         for stage in self.STAGES}}
+
+
+#----------------------------------------------------------------------
+# literal_filter: split a pattern into the literal text every match must
+#  contain.  Returns (prefix, runs): prefix is the lowercased literal a
+#  match has to start with ('' if none), runs are further literals that
+#  must appear somewhere in the input.  Patterns we can't reason about
+#  (alternations) get ('', ()) and are always tried.
+#----------------------------------------------------------------------
+_SPECIAL = set('.^$*+?{}[]|()')
+
+def literal_filter(pattern):
+  runs = []
+  cur = ''
+  starts_literal = True
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    if c == '\\' and i + 1 < len(pattern) and not pattern[i+1].isalnum():
+      lit, i = pattern[i+1], i + 2
+    elif c == '|':
+      return '', ()
+    elif c in _SPECIAL or c == '\\':
+      # groups, classes, wildcards and \d-style escapes end a literal run
+      if c == '(' or c == '[':
+        i = _skip_bracket(pattern, i)
+      else:
+        i += 2 if c == '\\' else 1
+      if i < len(pattern) and pattern[i] in '?*+{':
+        i = _skip_quantifier(pattern, i)
+      if cur: runs.append(cur)
+      elif not runs: starts_literal = False
+      cur = ''
+      continue
+    else:
+      lit, i = c, i + 1
+    if i < len(pattern) and pattern[i] in '?*{':
+      # optional literal: can't be relied upon
+      i = _skip_quantifier(pattern, i)
+      if cur: runs.append(cur)
+      elif not runs: starts_literal = False
+      cur = ''
+      continue
+    cur += lit.lower()
+    if i < len(pattern) and pattern[i] == '+':
+      i = _skip_quantifier(pattern, i)
+      runs.append(cur)
+      cur = ''
+  if cur: runs.append(cur)
+  if starts_literal and runs:
+    return runs[0], tuple(runs[1:])
+  return '', tuple(runs)
+
+def _skip_bracket(pattern, i):
+  # return the index just past the group or class starting at pattern[i]
+  if pattern[i] == '[':
+    i += 1
+    if i < len(pattern) and pattern[i] == '^': i += 1
+    if i < len(pattern) and pattern[i] == ']': i += 1
+    while i < len(pattern) and pattern[i] != ']':
+      i += 2 if pattern[i] == '\\' else 1
+    return i + 1
+  depth = 0
+  while i < len(pattern):
+    c = pattern[i]
+    if c == '\\':
+      i += 2
+      continue
+    if c == '[':
+      i = _skip_bracket(pattern, i)
+      continue
+    if c == '(':
+      depth += 1
+    elif c == ')':
+      depth -= 1
+      if depth == 0:
+        return i + 1
+    i += 1
+  return i
+
+#----------------------------------------------------------------------
+# combinable: whether a pattern can be one alternative of a combined
+#  regex.  Backreferences and named groups refer to group numbers and
+#  names that change once the pattern sits among others, and a global
+#  inline flag like (?s) is an error anywhere but at the very start.
+#----------------------------------------------------------------------
+_GLOBAL_FLAGS = re.compile(r'\(\?[aiLmsux]+\)')
+
+def combinable(pattern):
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    if c == '\\':
+      if pattern[i+1:i+2] in set('123456789'):
+        return False
+      i += 2
+    elif c == '[':
+      i = _skip_bracket(pattern, i)
+    elif c == '(' and pattern.startswith('(?', i):
+      if pattern.startswith(('(?P=', '(?P<', '(?<', '(?('), i) \
+         and not pattern.startswith(('(?<=', '(?<!'), i):
+        return False
+      if _GLOBAL_FLAGS.match(pattern, i):
+        return False
+      i += 2
+    else:
+      i += 1
+  return True
+
+def _skip_quantifier(pattern, i):
+  if pattern[i] == '{':
+    i = pattern.find('}', i) + 1 or len(pattern)
+  else:
+    i += 1
+  if i < len(pattern) and pattern[i] in '?+':  # lazy/possessive suffix
+    i += 1
+  return i
+
+
+#----------------------------------------------------------------------
+# RuleIndex: matches the rule table with one combined alternation
+#  (first alternative that matches wins, just like trying the rules in
+#  order) and narrows it down before matching.  Rules with a literal
+#  prefix only go into the alternation for inputs starting with that
+#  letter; rules starting with a group only go in when their required
+#  literal occurs in the input.  The narrowed alternations are compiled
+#  on first use and kept, up to max_variants of them.  Rules that can't
+#  share an alternation (see combinable) are matched on their own, in
+#  their place in the table order.
+#----------------------------------------------------------------------
+class RuleIndex:
+  def __init__(self, patterns, flags=re.IGNORECASE, max_variants=256):
+    self.patterns = list(patterns)
+    self.flags = flags
+    self.filters = [literal_filter(p) for p in self.patterns]
+    self.groups = [re.compile(p, flags).groups for p in self.patterns]
+    self.alone = frozenset(i for i, p in enumerate(self.patterns) if not combinable(p))
+    self.heads = frozenset(prefix[0] for prefix, _ in self.filters if prefix)
+    self.gates = tuple((1 << i, max(runs, key=len))
+                       for i, (prefix, runs) in enumerate(self.filters)
+                       if not prefix and runs)
+    self.all_gates = sum(bit for bit, _ in self.gates)
+    self.max_variants = max_variants
+    self.variants = {}
+
+  def _compile(self, head, mask):
+    chosen = []
+    for i, (prefix, runs) in enumerate(self.filters):
+      if prefix:
+        if head is None or prefix[0] == head:
+          chosen.append(i)
+      elif not runs or mask & (1 << i):
+        chosen.append(i)
+    # runs of combinable rules share one regex, the others get one each;
+    # segments are (regex, slots) with slots None for a single rule
+    segments = []
+    run = []
+    for i in chosen + [None]:
+      if i is not None and i not in self.alone:
+        run.append(i)
+        continue
+      if run:
+        regex = re.compile('|'.join('(?P<r%d>%s)' % (j, self.patterns[j])
+                                    for j in run), self.flags)
+        segments.append((regex, {'r%d' % j: (j, regex.groupindex['r%d' % j], self.groups[j])
+                                 for j in run}))
+        run = []
+      if i is not None:
+        segments.append((re.compile(self.patterns[i], self.flags), i))
+    return tuple(segments), tuple(chosen)
+
+  def variant(self, text, lowered=None):
+    # non-ASCII input can case-fold in surprising ways under IGNORECASE
+    # (e.g. 'k' vs the Kelvin sign), so it gets the whole table
+    if text.isascii():
+      if lowered is None:
+        lowered = text.lower()
+      head = lowered[:1]
+      if head not in self.heads:
+        head = ''
+      mask = 0
+      for bit, literal in self.gates:
+        if literal in lowered:
+          mask |= bit
+    else:
+      head, mask = None, self.all_gates
+    key = (head, mask)
+    found = self.variants.get(key)
+    if found is None:
+      if len(self.variants) >= self.max_variants:
+        # out of room: the ungated variant for this head is always a
+        # correct (if slower) choice
+        key = (head, self.all_gates)
+        found = self.variants.get(key)
+      if found is None:
+        found = self.variants[key] = self._compile(*key)
+    return found
+
+  def match(self, text, lowered=None):
+    # returns (rule number, groups of that rule) or None
+    for regex, slots in self.variant(text, lowered)[0]:
+      match = regex.match(text)
+      if match is None:
+        continue
+      if isinstance(slots, int):
+        return slots, match.groups()
+      i, start, count = slots[match.lastgroup]
+      return i, match.groups()[start:start+count]
+    return None
+
+  def candidates(self, text, lowered=None):
+    # the rule numbers match() would try for text, in table order
+    return self.variant(text, lowered)[1]
+
+
+#----------------------------------------------------------------------
+# fix_punctuation: fix munged punctuation at the end of a reply
+#----------------------------------------------------------------------
+def fix_punctuation(resp):
+  if resp[-2:] == '?.': resp = resp[:-2] + '.'
+  if resp[-2:] == '??': resp = resp[:-2] + '?'
+  return resp
+
+#----------------------------------------------------------------------
+# compile_template: parse a response with group-macros (%1, %2, ...)
+#  into (format string, needs_fix).  The punctuation fix-up is applied
+#  right away when the end of the reply is fixed text; needs_fix says
+#  it has to wait until a group has been filled in.  Responses without
+#  macros come back as (text, None) and are used as they are.
+#----------------------------------------------------------------------
+_MACRO = re.compile(r'%([1-9])')
+
+def compile_template(resp):
+  parts = _MACRO.split(resp)
+  if len(parts) == 1:
+    return fix_punctuation(resp), None
+  needs_fix = len(parts[-1]) < 2
+  if not needs_fix:
+    parts[-1] = fix_punctuation(parts[-1])
+  fmt = ''
+  for pos, part in enumerate(parts):
+    if pos % 2:
+      fmt += '{%d}' % (int(part) - 1)
+    else:
+      fmt += part.replace('{', '{{').replace('}', '}}')
+  return fmt, needs_fix
+
+#----------------------------------------------------------------------
+# Reflector: translate with a reflection table in one pass over the
+#  words; gives the same result as Eliza.translate(text, table).
+#----------------------------------------------------------------------
+class Reflector:
+  def __init__(self, table):
+    self.table = dict(table)
+    self.lookup = self.table.get
+
+  def __call__(self, text):
+    words = text.lower().split()
+    return ' '.join(map(self.lookup, words, words))
+
+
+#----------------------------------------------------------------------
+# RuleStats: which rules fire and what matching costs.  For every rule
+#  of a RuleSet: how often it answered (hits, including answers from
+#  the match cache), how often it was tried and didn't match, and the
+#  time spent in its regex; plus how many messages the profanity,
+#  greeting and keysmash shortcuts handled.  Only collected by an Eliza
+#  given one, since it matches the rules one by one to time them.
+#----------------------------------------------------------------------
+class RuleStats:
+  SHORTCUTS = ('profanity', 'greeting', 'keysmash')
+
+  def __init__(self, rules):
+    self.rules = rules
+    self.patterns = [key.pattern for key in rules.keys]
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      count = len(self.patterns)
+      self.hits = [0] * count
+      self.rejected = [0] * count
+      self.seconds = [0.0] * count
+      self.shortcuts = dict.fromkeys(self.SHORTCUTS, 0)
+      self.messages = self.matched = self.cached = self.tries = 0
+
+  def record(self, kind, hit=None, tries=(), cached=False):
+    # kind: 'profanity', 'greeting', 'keysmash', 'rule' or None (no
+    # rule matched); tries: (rule number, matched, seconds) per regex run
+    with self.lock:
+      self.messages += 1
+      if kind in self.shortcuts:
+        self.shortcuts[kind] += 1
+        return
+      if hit is not None:
+        self.hits[hit] += 1
+        self.matched += 1
+      self.cached += cached
+      self.tries += len(tries)
+      for i, matched, seconds in tries:
+        if not matched:
+          self.rejected[i] += 1
+        self.seconds[i] += seconds
+
+  def as_dict(self):
+    with self.lock:
+      matched = self.matched - self.cached
+      return {'messages': self.messages,
+              'shortcuts': dict(self.shortcuts),
+              'matched': self.matched,
+              'from_cache': self.cached,
+              'tries_per_match': self.tries / matched if matched else None,
+              'rules': [{'rule': i, 'pattern': pattern,
+                         'hits': self.hits[i],
+                         'rejected': self.rejected[i],
+                         'match_ms': self.seconds[i] * 1e3}
+                        for i, pattern in enumerate(self.patterns)]}
+
+
+#----------------------------------------------------------------------
+# MatchCache: a size-bounded LRU of what the rule stage found for an
+#  input (rule number and reflected groups, or None), so repeated
+#  messages skip matching and reflecting.  Safe to share between
+#  threads.  Very long inputs are not worth keeping and are skipped.
+#----------------------------------------------------------------------
+MISSING = object()
+
+class MatchCache:
+  def __init__(self, maxsize=1024, max_key_length=256):
+    self.maxsize = maxsize
+    self.max_key_length = max_key_length
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = self.misses = self.evictions = 0
+
+  def get(self, key):
+    with self.lock:
+      try:
+        found = self.entries[key]
+      except KeyError:
+        self.misses += 1
+        return MISSING
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return found
+
+  def put(self, key, found):
+    if self.maxsize <= 0 or len(key) > self.max_key_length:
+      return
+    with self.lock:
+      self.entries[key] = found
+      self.entries.move_to_end(key)
+      self._trim()
+
+  def resize(self, maxsize):
+    with self.lock:
+      self.maxsize = maxsize
+      self._trim()
+
+  def _trim(self):
+    while len(self.entries) > self.maxsize:
+      self.entries.popitem(last=False)
+      self.evictions += 1
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def stats(self):
+    with self.lock:
+      return {'size': len(self.entries), 'maxsize': self.maxsize,
+              'hits': self.hits, 'misses': self.misses,
+              'evictions': self.evictions}
+
+
+#----------------------------------------------------------------------
+# RuleSet: a compiled, read-only rule table.  Building one compiles
+#  every pattern, so do it once (DEFAULT_RULES is built at import) and
+#  share it between all Eliza instances and threads.  Pre-forked WSGI
+#  workers inherit it from the parent process if the app is imported
+#  before forking.  Each rule set has its own MatchCache (cache_size
+#  entries, 0 turns it off).
+#----------------------------------------------------------------------
+class RuleSet:
+  def __init__(self, pats, reflections, cache_size=1024):
+    object.__setattr__(self, 'keys',
+                       tuple(re.compile(x[0], re.IGNORECASE) for x in pats))
+    object.__setattr__(self, 'values', tuple(tuple(x[1]) for x in pats))
+    object.__setattr__(self, 'templates',
+                       tuple(tuple(compile_template(r) for r in x[1]) for x in pats))
+    object.__setattr__(self, 'reflections', MappingProxyType(dict(reflections)))
+    object.__setattr__(self, 'reflect', Reflector(reflections))
+    object.__setattr__(self, 'index', RuleIndex([x[0] for x in pats]))
+    object.__setattr__(self, 'cache', MatchCache(cache_size))
+
+  def __setattr__(self, name, value):
+    raise AttributeError("RuleSet is read-only")
+
+  def warm(self):
+    # compile the common narrowed alternations up front
+    index = self.index
+    for head in list(index.heads) + ['']:
+      for mask in (0, index.all_gates):
+        if (head, mask) not in index.variants:
+          index.variants[head, mask] = index._compile(head, mask)
+    return self
+
+
+#----------------------------------------------------------------------
+# measure_construction_cost: time building a rule table from scratch
+#  (what every request used to pay) against an Eliza sharing one.
+#  Returns microseconds per construction.
+#----------------------------------------------------------------------
+def measure_construction_cost(repeat=200):
+  start = time.perf_counter()
+  for _ in range(repeat):
+    RuleSet(gPats, gReflections)
+  rebuilt = (time.perf_counter() - start) / repeat * 1e6
+  start = time.perf_counter()
+  for _ in range(repeat):
+    Eliza()
+  shared = (time.perf_counter() - start) / repeat * 1e6
+  return {'rebuild_us': rebuilt, 'shared_us': shared,
+          'saved_us': rebuilt - shared}
+
+
+class Eliza:
+  def __init__(self, rules=None, timings=None, stats=None):
+    self.rules = rules or DEFAULT_RULES
+    self.timings = timings
+    self.stats = stats
+    self.keys = self.rules.keys
+    self.values = self.rules.values
+    self.index = self.rules.index
 
   #----------------------------------------------------------------------
   # translate: take a string, replace any words found in vocabulary.keys()
@@ -62,43 +573,158 @@ class Eliza:
   #    set of response lists; find a match, and return a randomly
   #    chosen response from the corresponding list.
   #----------------------------------------------------------------------
-  def respond(self, text, sender):
-    # profanity check
-    if profanity.contains_profanity(text):
-      return random.sample(["We don't use such language here.",
-                            f"{sender}, this isn't very nice of you.",
-                            "Do you kiss your mother with that mouth?",
-                            "I see you are quite aggravated, have you tried calming down?"], 1)[0]
+  def respond(self, text, sender, rng=random, profane=None):
+    return self.render(self.classify(text, profane), sender, rng)
+
+  #----------------------------------------------------------------------
+  #  respond_many: respond to a batch of messages, replies come back in
+  #    input order.  senders is a list (or one name for all of them),
+  #    rng a random.Random to make the run reproducible.  Everything
+  #    but the random choice of reply is done once per distinct text.
+  #    texts may be Utterances, so text normalized earlier isn't again.
+  #    profane optionally lists the profanity filter's verdict per text.
+  #----------------------------------------------------------------------
+  def respond_many(self, texts, senders, rng=None, profane=None):
+    rng = rng or random
+    if isinstance(senders, str):
+      senders = [senders] * len(texts)
+    elif len(senders) != len(texts):
+      raise ValueError("need one sender per text")
+    if profane is None:
+      profane = [None] * len(texts)
+    elif len(profane) != len(texts):
+      raise ValueError("need one profanity flag per text")
+    keys = [text.text if isinstance(text, Utterance) else text for text in texts]
+    decided = {}
+    classify = self.classify
+    for key, text, flagged in zip(keys, texts, profane):
+      if key not in decided:
+        decided[key] = classify(text, flagged)
+    render = self.render
+    return [render(decided[key], sender, rng)
+            for key, sender in zip(keys, senders)]
+
+  #----------------------------------------------------------------------
+  #  classify: the deterministic part of respond.  Returns one of
+  #    ('profanity',), ('greeting',), ('keysmash',),
+  #    ('rule', rule number, reflected groups) or None.  Pass profane
+  #    if the text has already been through the profanity filter.
+  #    The text (or an Utterance of it) is normalized once and every
+  #    stage works on that.
+  #----------------------------------------------------------------------
+  def classify(self, text, profane=None):
+    if self.timings is not None or self.stats is not None:
+      return self._classify_instrumented(text, profane)
+    norm = text if isinstance(text, Utterance) else Utterance(text)
+    return (self._check_profanity(norm, profane) or self._check_greeting(norm)
+            or self._check_keysmash(norm) or self._check_rules(norm))
+
+  def _classify_instrumented(self, text, profane):
+    clock = time.perf_counter
+    start = clock()
+    norm = text if isinstance(text, Utterance) else Utterance(text)
+    spent = [clock() - start]
+    found = None
+    for check in (self._check_profanity, self._check_greeting,
+                  self._check_keysmash, self._check_rules):
+      start = clock()
+      found = check(norm, profane)
+      spent.append(clock() - start)
+      if found:
+        break
+    if self.timings is not None:
+      self.timings.record(spent)
+    if self.stats is not None and found and found[0] != 'rule':
+      self.stats.record(found[0])
+    return found
+
+  def _check_profanity(self, norm, profane=None):
+    if profane is None:
+      profane = DEFAULT_FILTER.scan(norm.text, norm.lowered).profane
+    return PROFANITY if profane else None
+
+  def _check_greeting(self, norm, profane=None):
     # say hello back
-    if any(greeting in text.lower() for greeting in ("hi", "hey", "hello", "hallo")):
-      return random.sample([f"Hello, {sender}! I'm glad you could drop by today.",
-                            f"Hi there {sender}, how are you today?",
-                            f"Hello {sender}, how are you feeling today?"],1)[0]
-    
-    # if keysmash be sassy
-    if is_keysmash(text):
-       return "Your neural pathways are as unstable as a poorly written program."
+    return GREETING if is_greeting(norm) else None
 
-    # find a match among keys
-    for i in range(0, len(self.keys)):
-      match = self.keys[i].match(text)
+  def _check_keysmash(self, norm, profane=None):
+    # if keysmash be sassy
+    return KEYSMASH if is_keysmash(norm) else None
+
+  def _check_rules(self, norm, profane=None):
+    # case doesn't change which rule matches or the reflected groups of
+    # ASCII text, so it is cached by its lowercased form
+    key = norm.lowered if norm.text.isascii() else norm.text
+    cache = self.rules.cache
+    found = cache.get(key)
+    if found is not MISSING:
+      if self.stats is not None:
+        self.stats.record('rule' if found else None,
+                          found[1] if found else None, cached=True)
+      return found
+    # find the first matching key (the index skips those that can't match)
+    if self.stats is not None:
+      found = self._match_counted(norm)
+    else:
+      found = self.index.match(norm.text, norm.lowered)
+    if found:
+      i, groups = found
+      reflect = self.rules.reflect
+      found = ('rule', i, tuple('' if g is None else reflect(g) for g in groups))
+    cache.put(key, found)
+    return found
+
+  def _match_counted(self, norm):
+    # same result as index.match, but tries the candidates one at a
+    # time so RuleStats learns what each of them costs
+    clock = time.perf_counter
+    keys = self.rules.keys
+    tries = []
+    found = None
+    for i in self.index.candidates(norm.text, norm.lowered):
+      start = clock()
+      match = keys[i].match(norm.text)
+      tries.append((i, match is not None, clock() - start))
       if match:
-        # found a match ... stuff with corresponding value
-        # chosen randomly from among the available options
-        resp = random.choice(self.values[i])
-        # we've got a response... stuff in reflected text where indicated
-        pos = resp.find('%')
-        while pos > -1:
-          num = int(resp[pos+1:pos+2])
-          resp = resp[:pos] + \
-            self.translate(match.group(num), gReflections) + \
-            resp[pos+2:]
-          pos = resp.find('%')
-        # fix munged punctuation at the end
-        if resp[-2:] == '?.': resp = resp[:-2] + '.'
-        if resp[-2:] == '??': resp = resp[:-2] + '?'
-        return resp
-    return None
+        found = i, match.groups()
+        break
+    self.stats.record('rule' if found else None,
+                      found[0] if found else None, tries)
+    return found
+
+  #----------------------------------------------------------------------
+  #  render: turn what classify found into a reply for sender
+  #----------------------------------------------------------------------
+  def render(self, found, sender, rng=random):
+    if found is None:
+      return None
+    kind = found[0]
+    if kind == 'profanity':
+      return rng.sample(["We don't use such language here.",
+                         f"{sender}, this isn't very nice of you.",
+                         "Do you kiss your mother with that mouth?",
+                         "I see you are quite aggravated, have you tried calming down?"], 1)[0]
+    if kind == 'greeting':
+      return rng.sample([f"Hello, {sender}! I'm glad you could drop by today.",
+                         f"Hi there {sender}, how are you today?",
+                         f"Hello {sender}, how are you feeling today?"],1)[0]
+    if kind == 'keysmash':
+      return "Your neural pathways are as unstable as a poorly written program."
+
+    _, i, groups = found
+    # found a match ... stuff with corresponding value
+    # chosen randomly from among the available options
+    fmt, needs_fix = rng.choice(self.rules.templates[i])
+    if needs_fix is None:
+      return fmt
+    # we've got a response... stuff in reflected text where indicated
+    resp = fmt.format(*groups)
+    return fix_punctuation(resp) if needs_fix else resp
+
+# what classify found, for the replies that don't depend on a rule
+PROFANITY = ('profanity',)
+GREETING = ('greeting',)
+KEYSMASH = ('keysmash',)
 
 #----------------------------------------------------------------------
 # gReflections, a translation table used to convert things you say
@@ -391,4 +1017,5 @@ gPats = [
     "How do you feel when you say that?"]] 
   ]
 
-
+# built once per process and shared by every Eliza()
+DEFAULT_RULES = RuleSet(gPats, gReflections).warm()
@@ -0,0 +1,51 @@
+"""
+encoded_window.py - a room's messages as ready-to-send response bodies
+
+GET / used to turn the window into JSON on every request.  An
+EncodedWindow holds the window already encoded: one JSON fragment per
+message and the whole array, plus (made on first use) its gzip
+compression.  A room keeps one and replaces it only when the store
+reports a different version, i.e. after a message was added or evicted,
+so a GET costs the same whatever the window size.
+
+?since= responses are cut from the encoded fragments without encoding
+anything again.  json_bytes() encodes the way jsonify() does, for the
+bodies the channel and the hub build themselves.
+"""
+
+import bisect
+import gzip
+
+
+def json_bytes(app, data):
+    """data as app's jsonify() would send it, without the final newline."""
+    return app.json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+class EncodedWindow:
+    def __init__(self, store, version, messages, encode, gzip_level=6):
+        """encode: turns one message into bytes of JSON"""
+        self.store = store        # which store it was read from
+        self.version = version
+        self.gzip_level = gzip_level
+        self.ids = [message['id'] for message in messages]
+        self.parts = [encode(message) for message in messages]
+        self.body = self._join(self.parts)
+        self.etag = '%d-%d' % version
+        self.compressed = None
+
+    def since(self, since):
+        """The messages with an id above since, encoded."""
+        if since is None:
+            return self.body
+        return self._join(self.parts[bisect.bisect_right(self.ids, since):])
+
+    def gzipped(self):
+        # compressed on first request, then reused until the window changes
+        if self.compressed is None:
+            self.compressed = gzip.compress(self.body, self.gzip_level)
+        return self.compressed
+
+    @staticmethod
+    def _join(parts):
+        return b'[' + b','.join(parts) + b']\n'
@@ -0,0 +1,84 @@
+"""
+health_checks.py - check many channels' /health at once
+
+The hub used to ask one channel after another, without a timeout, so a
+single channel that never answered stalled the whole sweep.
+HealthChecker sends the requests from a pool of at most max_workers
+threads, each with a connect and a read timeout, and gives up on
+everything still running when the sweep's deadline (the two timeouts
+plus a grace period) has passed.  A sweep therefore takes about as long
+as the slowest timeout, whatever the number of channels.
+
+The checker knows nothing about the database: the hub hands it
+(endpoint, authkey, name) tuples and stores the results itself.
+"""
+
+import concurrent.futures
+import time
+from collections import namedtuple
+
+import requests
+
+from per_process import PerProcess
+
+# ok: the channel answered with its registered name; reason says what went wrong
+HealthResult = namedtuple('HealthResult', 'endpoint ok reason elapsed')
+
+
+def probe(endpoint, authkey, name, timeout):
+    """GET endpoint/health once; a HealthResult."""
+    start = time.monotonic()
+
+    def result(ok, reason=None):
+        return HealthResult(endpoint, ok, reason, time.monotonic() - start)
+
+    try:
+        response = requests.get(endpoint + '/health', timeout=timeout,
+                                headers={'Authorization': 'authkey ' + authkey})
+    except requests.exceptions.Timeout:
+        return result(False, 'timeout')
+    except requests.exceptions.RequestException as e:
+        return result(False, type(e).__name__)
+    if response.status_code != 200:
+        return result(False, 'status %d' % response.status_code)
+    try:
+        answer = response.json()
+    except ValueError:
+        return result(False, 'no JSON')
+    # channels can't change their name, they must register again
+    if not isinstance(answer, dict) or answer.get('name') != name:
+        return result(False, 'wrong name')
+    return result(True)
+
+
+class HealthChecker:
+    def __init__(self, connect_timeout=2.0, read_timeout=5.0, max_workers=32, grace=1.0):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_workers = max_workers
+        # requests' read timeout is per read, a trickling channel needs a deadline too
+        self.deadline = connect_timeout + read_timeout + grace
+        # one pool reused by every sweep; threads don't survive a fork, so one per process
+        self.pool = PerProcess(lambda: concurrent.futures.ThreadPoolExecutor(
+            self.max_workers, thread_name_prefix='health-check'))
+
+    def check(self, endpoint, authkey, name):
+        return probe(endpoint, authkey, name, self.timeout)
+
+    def check_all(self, channels):
+        """Check (endpoint, authkey, name) tuples concurrently; results in the same order."""
+        channels = list(channels)
+        pool = self.pool.get()
+        futures = [pool.submit(probe, endpoint, authkey, name, self.timeout)
+                   for endpoint, authkey, name in channels]
+        # queued checks start late, so the deadline grows with the waves of checks
+        waves = -(-len(channels) // self.max_workers) if channels else 0
+        done, _ = concurrent.futures.wait(futures, timeout=self.deadline * max(waves, 1))
+        results = []
+        for (endpoint, _, _), future in zip(channels, futures):
+            if future in done:
+                results.append(future.result())
+            else:
+                future.cancel()
+                results.append(HealthResult(endpoint, False, 'deadline', self.deadline))
+        return results
+
@@ -0,0 +1,258 @@
+"""
+heartbeat.py - check every channel on a schedule of its own
+
+HeartbeatScheduler runs in a background thread of the hub.  Every tick
+it checks the channels that are due (concurrently, through a
+HealthChecker) and stores the results:
+
+- a healthy channel gets a heartbeat, and its interval grows by
+  `growth` after every success, from `interval` up to `max_interval`;
+- a failing channel is retried after `retry` seconds, doubling up to
+  `max_interval`, and is only marked inactive after `failures` failed
+  checks in a row;
+- every interval is stretched or shrunk by up to `jitter` at random, so
+  channels registered together don't stay in step.
+
+Channels can also push heartbeats to the hub.  pushed() (and, for
+pushes another process received, a heartbeat in the database newer than
+the last check) counts as a successful check and postpones the next poll
+by max_interval: channels that keep pushing are never polled, and
+polling takes over when they stop.  With an expire callback, every tick
+also deactivates the channels whose last heartbeat is too old.
+
+status() gives the state of the last checks without checking anything.
+
+Only one process should check the channels.  With lock_path set, the
+process holding that file lock schedules; the others keep trying to get
+the lock, so one of them takes over when the scheduling process exits.
+"""
+
+import os
+import random
+import threading
+import time
+
+from per_process import PerProcess, fcntl
+
+
+class ChannelState:
+    __slots__ = ('id', 'endpoint', 'authkey', 'name', 'active', 'healthy', 'failures',
+                 'reason', 'interval', 'due', 'last_check')
+
+    def __init__(self, id, endpoint, authkey, name, active):
+        self.id = id
+        self.endpoint = endpoint
+        self.authkey = authkey
+        self.name = name
+        self.active = active
+        self.healthy = None     # result of the last check, None before the first
+        self.failures = 0       # failed checks in a row
+        self.reason = None
+        self.interval = None
+        self.due = 0.0          # time.monotonic() of the next check
+        self.last_check = None  # time.time() of the last check
+
+
+class HeartbeatScheduler:
+    def __init__(self, checker, load, store, interval=30.0, max_interval=300.0, growth=1.5,
+                 retry=5.0, failures=3, jitter=0.2, tick=1.0, reload_every=30.0,
+                 lock_path=None, expire=None):
+        """checker: a HealthChecker
+        load: returns the channels as (id, endpoint, authkey, name, active, last heartbeat)
+            tuples, the heartbeat as a time.time() value or None
+        store: called with the ids of healthy channels and of channels to deactivate
+        expire: deactivates channels without recent heartbeats, returns their ids
+        """
+        self.checker = checker
+        self.load = load
+        self.store = store
+        self.interval = interval
+        self.max_interval = max_interval
+        self.growth = growth
+        self.retry = retry
+        self.failures = failures
+        self.jitter = jitter
+        self.tick = tick
+        self.reload_every = reload_every
+        self.lock_path = lock_path
+        self.expire = expire
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.states = {}
+        self.next_reload = 0.0
+        self.thread = PerProcess(self._spawn)
+        self.lock_file = None
+        self.sweeps = 0
+        self.checks = 0
+        self.pushes = 0
+        self.expired = 0
+        self.last_error = None
+
+    def start(self):
+        """Start the scheduler thread, once per process."""
+        self.thread.get()
+
+    def _spawn(self):
+        with self.lock:
+            self.states = {}
+            self.lock_file = None
+        thread = threading.Thread(target=self._run, daemon=True, name='heartbeat')
+        thread.start()
+        return thread
+
+    def refresh(self):
+        """Read the channels again at the next tick, e.g. after a registration."""
+        self.next_reload = 0.0
+        self.wakeup.set()
+
+    @property
+    def leading(self):
+        return self.thread.ready and (self.lock_path is None or fcntl is None
+                                            or self.lock_file is not None)
+
+    def stats(self):
+        return {'leading': self.leading,
+                'channels': len(self.states),
+                'sweeps': self.sweeps,
+                'checks': self.checks,
+                'pushes': self.pushes,
+                'expired': self.expired,
+                'last_error': self.last_error}
+
+    def status(self):
+        """The last known state of the channels, by id."""
+        now = time.monotonic()
+        with self.lock:
+            states = sorted(self.states.values(), key=lambda state: state.id)
+        return [self._describe(state, now) for state in states]
+
+    def pushed(self, ids):
+        """Channels that reported themselves alive: no need to poll them for a while."""
+        now, wall = time.monotonic(), time.time()
+        with self.lock:
+            for id in ids:
+                state = self.states.get(id)
+                if state is not None:
+                    self._heard_from(state, wall, now, wall)
+            self.pushes += len(ids)
+
+    def run_once(self, now=None):
+        """Check the channels that are due; returns how many were checked."""
+        now = time.monotonic() if now is None else now
+        if now >= self.next_reload:
+            self._reload(now)
+        if self.expire is not None:
+            expired = self.expire()
+            with self.lock:
+                for id in expired:
+                    state = self.states.get(id)
+                    if state is not None:
+                        state.active = False
+                        state.due = now  # check it now, in case only its pushes stopped
+                self.expired += len(expired)
+        with self.lock:
+            due = [state for state in self.states.values() if state.due <= now]
+        if not due:
+            return 0
+        results = self.checker.check_all((s.endpoint, s.authkey, s.name) for s in due)
+        finished = time.monotonic()
+        healthy, inactive = [], []
+        with self.lock:
+            for state, result in zip(due, results):
+                self._schedule(state, result, finished)
+                if result.ok:
+                    healthy.append(state.id)
+                    state.active = True
+                elif state.active and state.failures >= self.failures:
+                    inactive.append(state.id)
+                    state.active = False
+            self.sweeps += 1
+            self.checks += len(due)
+        self.store(healthy, inactive)
+        return len(due)
+
+    def _schedule(self, state, result, now):
+        if result.ok:
+            if state.healthy:
+                state.interval = min(self.max_interval, state.interval * self.growth)
+            else:
+                state.interval = self.interval
+            state.failures = 0
+        else:
+            state.failures += 1
+            state.interval = min(self.max_interval, self.retry * 2 ** (state.failures - 1))
+        state.healthy = result.ok
+        state.reason = result.reason
+        state.last_check = time.time()
+        state.due = now + state.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _heard_from(self, state, at, now, wall):
+        # a heartbeat at time.time() value at: the channel is fine until max_interval after it
+        state.healthy = state.active = True
+        state.failures = 0
+        state.reason = None
+        state.last_check = at
+        state.interval = self.max_interval
+        state.due = max(state.due, now + at + self.max_interval - wall)
+
+    def _reload(self, now):
+        # pick up new, changed and deleted channels, keeping the schedules of the others
+        channels = self.load()
+        wall = time.time()
+        with self.lock:
+            states = {}
+            for id, endpoint, authkey, name, active, heartbeat in channels:
+                state = self.states.get(id)
+                if state is None or (state.endpoint, state.authkey, state.name) != (endpoint, authkey, name):
+                    state = ChannelState(id, endpoint, authkey, name, active)
+                    # spread the first checks over one interval
+                    state.due = now + random.uniform(0, self.interval)
+                else:
+                    state.active = active
+                # a recent heartbeat we didn't store ourselves (ours come a moment after last_check)
+                if (active and heartbeat and heartbeat + self.max_interval > wall
+                        and heartbeat > (state.last_check or 0) + self.tick + 1):
+                    self._heard_from(state, heartbeat, now, wall)
+                states[id] = state
+            self.states = states
+        self.next_reload = now + self.reload_every
+
+    def _lead(self):
+        # whether this process schedules; takes the lock file when it is free
+        if self.lock_path is None or fcntl is None or self.lock_file is not None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.lock_path)), exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file  # held until the process exits
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                if self._lead():
+                    self.run_once()
+                    self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Heartbeat sweep failed: {e}")
+            self.wakeup.wait(self.tick)
+            self.wakeup.clear()
+
+    @staticmethod
+    def _describe(state, now):
+        return {'id': state.id,
+                'name': state.name,
+                'endpoint': state.endpoint,
+                'active': state.active,
+                'healthy': state.healthy,
+                'failures': state.failures,
+                'reason': state.reason,
+                'last_check': (time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(state.last_check))
+                               if state.last_check else None),
+                'next_check_in': max(0.0, round(state.due - now, 1)),
+                'interval': state.interval}
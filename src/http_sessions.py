@@ -0,0 +1,141 @@
+"""
+http_sessions.py - kept-alive HTTP connections to the hub and the channels
+
+The client used to call requests.get()/requests.post() for every page,
+which opens (and closes) a new connection each time.  SessionPool keeps
+one connection pool per upstream host (scheme, host and port) and reuses
+its connections across requests and threads, with a connect and a read
+timeout on every request.
+
+requests.Session is not meant to be shared between threads (its cookies
+and adapter mounts are plain dicts), while the urllib3 pools below its
+adapters are.  So every thread gets a Session of its own, and all of
+them send through the same per-host adapters.  A forked worker starts
+with empty pools, the parent's sockets are not shared.
+
+requests also looks up proxies and CA bundles in the environment (and
+~/.netrc) on every request, which costs about as much as the request
+itself on a fast network.  SessionPool looks up the proxies and the CA
+bundle once per host and turns the lookup off; ~/.netrc is not read.
+
+stats() shows, per host, how many requests went out, how many new
+connections that took and how many connections are idle or in use.
+"""
+
+import threading
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from per_process import PerProcess
+
+
+class HostStats:
+    __slots__ = ('settings', 'requests', 'errors', 'in_use')
+
+    def __init__(self, settings):
+        self.settings = settings  # proxies and verify, from the environment
+        self.requests = 0
+        self.errors = 0     # requests that raised, e.g. timeouts and refused connections
+        self.in_use = 0
+
+
+class SessionPool:
+    def __init__(self, connect_timeout=2.0, read_timeout=10.0, max_connections=16):
+        """max_connections: idle connections kept per host; more threads than that
+        still get connections, but the extra ones are closed after their request
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.adapters = {}  # 'scheme://host:port/' -> HTTPAdapter
+        self.hosts = {}     # same keys -> HostStats
+        self.process = PerProcess(self._forget)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """Like requests.request(), through the host's pool and with the default timeouts."""
+        kwargs.setdefault('timeout', self.timeout)
+        prefix, adapter, stats = self._adapter(url)
+        for name, value in stats.settings.items():
+            kwargs.setdefault(name, value)
+        session = self._session()
+        if prefix not in session.adapters:
+            session.mount(prefix, adapter)
+        with self.lock:
+            stats.requests += 1
+            stats.in_use += 1
+        try:
+            return session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            with self.lock:
+                stats.errors += 1
+            raise
+        finally:
+            with self.lock:
+                stats.in_use -= 1
+
+    def stats(self):
+        with self.lock:
+            hosts = list(self.hosts.items())
+            adapters = dict(self.adapters)
+        result = {}
+        for prefix, stats in hosts:
+            connections = idle = 0
+            manager = adapters[prefix].poolmanager
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    if pool.pool is not None:
+                        # the queue is filled up with None for connections not made yet
+                        with pool.pool.mutex:
+                            idle += sum(conn is not None for conn in pool.pool.queue)
+            result[prefix.rstrip('/')] = {'requests': stats.requests,
+                                          'errors': stats.errors,
+                                          'in_use': stats.in_use,
+                                          'idle': idle,
+                                          'connections_opened': connections}
+        return {'timeout': self.timeout,
+                'max_connections': self.max_connections,
+                'hosts': result}
+
+    def close(self):
+        with self.lock:
+            adapters, self.adapters, self.hosts = self.adapters, {}, {}
+        for adapter in adapters.values():
+            adapter.close()
+
+    def _adapter(self, url):
+        # the prefix requests matches the prepared URL (lower case, with a path) against
+        parts = urllib.parse.urlsplit(url)
+        prefix = '%s://%s/' % (parts.scheme.lower(), parts.netloc.lower())
+        with self.lock:
+            self.process.get()
+            adapter = self.adapters.get(prefix)
+            if adapter is None:
+                adapter = self.adapters[prefix] = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.max_connections)
+                settings = requests.Session().merge_environment_settings(prefix, {}, None, None, None)
+                self.hosts[prefix] = HostStats({'proxies': settings['proxies'],
+                                                'verify': settings['verify']})
+            return prefix, adapter, self.hosts[prefix]
+
+    def _forget(self):
+        # the parent's connections are not ours to use
+        self.adapters, self.hosts = {}, {}
+
+    def _session(self):
+        # one Session per thread, replaced when the pools were (after close() or a fork)
+        if getattr(self.local, 'adapters', None) is not self.adapters:
+            self.local.session = requests.Session()
+            self.local.session.trust_env = False  # see the settings of HostStats
+            self.local.adapters = self.adapters
+        return self.local.session
@@ -1,8 +1,15 @@
-from flask import Flask, request, render_template, jsonify, redirect, url_for
+from flask import Flask, request, render_template, jsonify
 from flask_sqlalchemy import SQLAlchemy
 import json
 import datetime
-import requests
+import os
+import time
+from sqlalchemy import func, select, update
+
+from channel_directory import ChannelDirectory
+from encoded_window import json_bytes
+from health_checks import HealthChecker
+from heartbeat import HeartbeatScheduler
 
 db = SQLAlchemy()
 
@@ -15,6 +22,8 @@ class Channel(db.Model):
     authkey = db.Column(db.String(100, collation='NOCASE'), nullable=False)
     type_of_service = db.Column(db.String(100, collation='NOCASE'), nullable=False)
     last_heartbeat = db.Column(db.DateTime(), nullable=True, server_default=None)
+    # one index for both the active channels and the expired ones among them
+    __table_args__ = (db.Index('ix_channels_active_heartbeat', 'is_active', 'last_heartbeat'),)
 
 
 # Class-based application configuration
@@ -25,7 +34,8 @@ class ConfigClass(object):
     SECRET_KEY = 'This is an INSECURE secret!! DO NOT use this in production!!'
 
     # Flask-SQLAlchemy settings
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///chat_server.sqlite'  # File-based SQL database
+    # File-based SQL database; HUB_DATABASE_URI points e.g. loadtest.py at a scratch one
+    SQLALCHEMY_DATABASE_URI = os.environ.get('HUB_DATABASE_URI', 'sqlite:///chat_server.sqlite')
     SQLALCHEMY_TRACK_MODIFICATIONS = False  # Avoids SQLAlchemy warning
 
 # Create Flask app
@@ -34,57 +44,161 @@ app.config.from_object(__name__ + '.ConfigClass')  # configuration
 app.app_context().push()  # create an app context before initializing db
 db.init_app(app)  # initialize database
 db.create_all()  # create database if necessary
+for index in Channel.__table__.indexes:
+    index.create(db.engine, checkfirst=True)  # create_all() skips them on existing tables
 
 SERVER_AUTHKEY = '1234567890'
 STANDARD_CLIENT_URL = 'http://localhost:5005' # standard configuration in client.py, chang to real URL if necessary
 
+HEALTH_CONNECT_TIMEOUT = 2 # seconds to wait for a channel to accept the connection
+HEALTH_READ_TIMEOUT = 5 # seconds to wait for its answer
+HEALTH_CONCURRENCY = 64 # channels checked at the same time
+
+HEARTBEAT_SCHEDULER = True # check channels in the background instead of on GET /health
+HEARTBEAT_INTERVAL = 30 # seconds between checks of a healthy channel at first ...
+HEARTBEAT_MAX_INTERVAL = 300 # ... growing up to this while it stays healthy
+HEARTBEAT_RETRY = 5 # seconds until a failed channel is checked again, doubling per failure
+HEARTBEAT_FAILURES = 3 # failed checks in a row before a channel is marked inactive
+HEARTBEAT_EXPIRY = 600 # seconds without a heartbeat (pushed or polled) until a channel is inactive
+HEARTBEAT_BATCH_LIMIT = 1000 # most heartbeats accepted by one POST /heartbeat
+DIRECTORY_TTL = 5 # seconds until the cached channel list is checked for other processes' changes
+
+HEALTH_CHECKER = HealthChecker(HEALTH_CONNECT_TIMEOUT, HEALTH_READ_TIMEOUT, HEALTH_CONCURRENCY)
+
 def health_check(endpoint, authkey):
-    # make GET request to URL
-    # add authkey to request header
-    try:
-        response = requests.get(endpoint+'/health',
-                                headers={'Authorization': 'authkey '+authkey})
-    except requests.exceptions.RequestException as e:
-        print(f"Error: {e}")
-        return False
-    if response.status_code != 200:
-        return False
-    # check if response is JSON with {"name": <channel_name>}
-    if 'name' not in response.json():
-        return False
-    # check if channel name is as expected
-    # (channels can't change their name, must be re-registered)
+    # check one channel (e.g. one that just registered) and store the result
     channel = Channel.query.filter_by(endpoint=endpoint).first()
-    channel.active = False
-    db.session.commit()
     if not channel:
         print(f"Channel {endpoint} not found in database")
         return False
-    expected_name = channel.name
-    if response.json()['name'] != expected_name:
-        return False
+    result = HEALTH_CHECKER.check(endpoint, authkey, channel.name)
+    apply_health_results([channel], [result])
+    return result.ok
+
+def check_all_channels(channels=None):
+    """Check channels (all by default) concurrently, store the results in one transaction."""
+    if channels is None:
+        channels = Channel.query.all()
+    results = HEALTH_CHECKER.check_all((c.endpoint, c.authkey, c.name) for c in channels)
+    apply_health_results(channels, results)
+    return results
+
+def apply_health_results(channels, results):
+    store_heartbeats([c.id for c, result in zip(channels, results) if result.ok],
+                     [c.id for c, result in zip(channels, results) if not result.ok])
+
+def store_heartbeats(healthy_ids, inactive_ids):
+    # one executemany UPDATE for all channels instead of a commit per channel
+    now = datetime.datetime.now()
+    rows = ([{'id': id, 'active': True, 'last_heartbeat': now} for id in healthy_ids]
+            + [{'id': id, 'active': False} for id in inactive_ids])
+    if rows:
+        db.session.execute(update(Channel), rows)
+    db.session.commit()
+    DIRECTORY.affected_by(healthy_ids, inactive_ids)
+
+def accept_heartbeats(heartbeats):
+    """Store pushed heartbeats.
+
+    Returns the ids of the channels, the unknown endpoints and the
+    endpoints whose authkey is wrong.
+    """
+    # endpoints compare case-insensitively, like their column; authkeys must match exactly
+    wanted = {(beat['endpoint'].lower(), beat['authkey']) for beat in heartbeats}
+    rows = db.session.execute(select(Channel.id, Channel.endpoint, Channel.authkey)
+                              .where(Channel.endpoint.in_({e for e, _ in wanted}))).all()
+    ids = [id for id, endpoint, authkey in rows if (endpoint.lower(), authkey) in wanted]
+    accepted = {endpoint.lower() for _, endpoint, authkey in rows
+                if (endpoint.lower(), authkey) in wanted}
+    registered = {endpoint.lower() for _, endpoint, _ in rows}
+    store_heartbeats(ids, [])
+    return (ids, sorted({e for e, _ in wanted} - registered),
+            sorted(registered - accepted))
 
-    # everything is OK, set last_heartbeat to now
-    channel.active = True
-    channel.last_heartbeat = datetime.datetime.now()
-    db.session.commit()  # save to database
-    return True
+EXPIRY_DUE = None # before this time no channel can have expired, None to look
+
+def expire_channels():
+    """Mark channels inactive that sent no heartbeat for HEARTBEAT_EXPIRY; returns their ids."""
+    global EXPIRY_DUE
+    now = datetime.datetime.now()
+    if EXPIRY_DUE is not None and now < EXPIRY_DUE:
+        return []
+    expiry = datetime.timedelta(seconds=HEARTBEAT_EXPIRY)
+    # a range of ix_channels_active_heartbeat
+    ids = db.session.execute(update(Channel)
+                             .where(Channel.active == True, Channel.last_heartbeat < now - expiry)
+                             .values(active=False)
+                             .returning(Channel.id)).scalars().all()
+    # heartbeats only get newer, so the oldest one left is the next to expire
+    oldest = db.session.execute(select(func.min(Channel.last_heartbeat))
+                                .where(Channel.active == True)).scalar()
+    db.session.commit()
+    EXPIRY_DUE = (oldest or now) + expiry
+    DIRECTORY.affected_by([], ids)
+    return ids
+
+def active_channels():
+    # the rows behind the cached directory, read through ix_channels_active_heartbeat
+    return [{'id': c.id, 'name': c.name, 'endpoint': c.endpoint, 'authkey': c.authkey,
+             'type_of_service': c.type_of_service, 'active': c.active,
+             'last_heartbeat': c.last_heartbeat}
+            for c in Channel.query.filter_by(active=True).order_by(Channel.id).all()]
+
+def encode_json(data):
+    return json_bytes(app, data) + b'\n'
+
+DIRECTORY = ChannelDirectory(active_channels, encode_json, DIRECTORY_TTL)
+
+def load_channels():
+    with app.app_context():
+        return [(c.id, c.endpoint, c.authkey, c.name, c.active,
+                 c.last_heartbeat.timestamp() if c.last_heartbeat else None)
+                for c in Channel.query.all()]
+
+def store_scheduled_heartbeats(healthy_ids, inactive_ids):
+    with app.app_context():
+        store_heartbeats(healthy_ids, inactive_ids)
+
+def expire_scheduled_channels():
+    with app.app_context():
+        return expire_channels()
+
+SCHEDULER = HeartbeatScheduler(HEALTH_CHECKER, load_channels, store_scheduled_heartbeats,
+                               HEARTBEAT_INTERVAL, HEARTBEAT_MAX_INTERVAL,
+                               retry=HEARTBEAT_RETRY, failures=HEARTBEAT_FAILURES,
+                               expire=expire_scheduled_channels,
+                               lock_path=os.path.join(app.instance_path, 'heartbeat.lock'))
+
+@app.before_request
+def start_heartbeats():
+    # in the process that serves requests, not in CLI commands (and once per worker)
+    if HEARTBEAT_SCHEDULER:
+        SCHEDULER.start()
 
 # cli command to check health of all channels
 @app.cli.command('check_channels')
 def check_channels():
-    channels = Channel.query.all()
-    for channel in channels:
-        if not health_check(channel.endpoint, channel.authkey):
-            print(f"Channel {channel.endpoint} is not healthy")
+    start = time.monotonic()
+    results = check_all_channels()
+    for result in results:
+        if not result.ok:
+            print(f"Channel {result.endpoint} is not healthy ({result.reason})")
         else:
-            print(f"Channel {channel.endpoint} is healthy")
+            print(f"Channel {result.endpoint} is healthy")
+    print(f"Checked {len(results)} channels in {time.monotonic() - start:.1f}s, "
+          f"{sum(not r.ok for r in results)} unhealthy")
+
+# cli command for hubs without the scheduler, e.g. from cron
+@app.cli.command('expire_channels')
+def expire_channels_command():
+    ids = expire_channels()
+    print(f"{len(ids)} channels sent no heartbeat for {HEARTBEAT_EXPIRY}s and are inactive now")
 
 # The Home page is accessible to anyone
 @app.route('/')
 def home_page():
     # find all active channels
-    channels = Channel.query.filter_by(active=True).all()
+    channels = DIRECTORY.current().channels
     # render hub_home.html template
     return render_template("hub_home.html", channels=channels, STANDARD_CLIENT_URL=STANDARD_CLIENT_URL)
 
@@ -119,8 +233,10 @@ def create_channel():
         update_channel.type_of_service = record['type_of_service']
         update_channel.active = False
         db.session.commit()
+        DIRECTORY.invalidate()  # its name, authkey or type may have changed
         if not health_check(record['endpoint'], record['authkey']):
             return "Channel is not healthy", 400
+        SCHEDULER.refresh()
         return jsonify(created=False,
                        id=update_channel.id), 200
     else:  # new channel, create it
@@ -136,34 +252,68 @@ def create_channel():
             # delete channel from database
             db.session.delete(channel)
             db.session.commit()
+            DIRECTORY.invalidate()
             return "Channel is not healthy", 400
 
+        SCHEDULER.refresh()
         return jsonify(created=True, id=channel.id), 200
 
 
 @app.route('/channels', methods=['GET'])
 def get_channels():
-    channels = Channel.query.filter_by(active=True).all()
+    # serialized once per change of the active channels
+    directory = DIRECTORY.current()
+    if request.if_none_match.contains(directory.etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(directory.body, mimetype='application/json')
+    response.set_etag(directory.etag)
+    response.headers['X-Directory-Version'] = str(directory.version)
+    return response
 
-    return jsonify(channels=[{'name': c.name,
-                              'endpoint': c.endpoint,
-                              'authkey': c.authkey,
-                              'type_of_service': c.type_of_service} for c in channels]), 200
+
+# Channels push heartbeats here instead of waiting to be polled:
+# {"endpoint": ..., "authkey": ...} or {"heartbeats": [{"endpoint": ..., "authkey": ...}, ...]}
+@app.route('/heartbeat', methods=['POST'])
+def receive_heartbeats():
+    if request.headers.get('Authorization') != 'authkey ' + SERVER_AUTHKEY:
+        return "Invalid authorization", 400
+    record = request.get_json(silent=True)
+    heartbeats = record.get('heartbeats') if isinstance(record, dict) and 'heartbeats' in record else [record]
+    if not isinstance(heartbeats, list) or not all(
+            isinstance(beat, dict) and isinstance(beat.get('endpoint'), str)
+            and isinstance(beat.get('authkey'), str) for beat in heartbeats):
+        return "Heartbeats need an endpoint and an authkey", 400
+    if len(heartbeats) > HEARTBEAT_BATCH_LIMIT:
+        return "Too many heartbeats, at most %d" % HEARTBEAT_BATCH_LIMIT, 413
+    ids, unknown, unauthorized = accept_heartbeats(heartbeats)
+    SCHEDULER.pushed(ids)
+    return jsonify(accepted=len(ids), unknown=unknown, unauthorized=unauthorized), 200
 
 
 @app.route('/health', methods=['GET'])
 def health():
-    # check either all channels or a specific channel (if id is provided)
-    if 'id' in request.args:
-        channel = Channel.query.filter_by(id=request.args['id']).first()
-        health_check(channel.endpoint, channel.authkey)
+    # the state of all channels or of one (if id is provided), without checking them now
+    channel_id = request.args.get('id')
+    if channel_id is not None:
+        try:
+            channel_id = int(channel_id)
+        except ValueError:
+            return "Invalid id", 400
+    if HEARTBEAT_SCHEDULER and SCHEDULER.leading:
+        channels = SCHEDULER.status()
     else:
-        channels = Channel.query.all()
-        for channel in channels:
-            health_check(channel.endpoint, channel.authkey)
-
-    # flask redirect to home page
-    return redirect(url_for('home_page'))
+        # another process checks the channels (or nobody does): what the database knows
+        channels = [{'id': c.id, 'name': c.name, 'endpoint': c.endpoint, 'active': c.active,
+                     'last_heartbeat': c.last_heartbeat.isoformat() if c.last_heartbeat else None}
+                    for c in Channel.query.order_by(Channel.id).all()]
+    if channel_id is not None:
+        channels = [c for c in channels if c['id'] == channel_id]
+        if not channels:
+            return "Channel not found", 404
+        return jsonify(channels[0]), 200
+    return jsonify(scheduler=SCHEDULER.stats() if HEARTBEAT_SCHEDULER else None,
+                   channels=channels), 200
 
 
 
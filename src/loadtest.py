@@ -0,0 +1,447 @@
+"""
+loadtest.py - drive the channel, the hub and the client with simulated users
+
+Starts a hub, a channel and a client on localhost, registers the channel
+with the hub and lets --users threads act like chat users for --duration
+seconds.  Everything runs offline: the hub's database, the channel's
+messages and its archive live in a temporary directory, and the real
+HUB_URL is never contacted.  Each user picks its next action at random,
+weighted by --mix:
+
+    post      POST a message to the channel
+    poll      GET the channel's new messages (?since= and If-None-Match)
+    channels  GET the hub's channel list
+    view      open the channel in the client (GET /show)
+    send      post a message through the client's form (POST /post)
+
+--mode threads serves the three apps from this process, --mode processes
+starts a server process per app (closer to a deployment, and the users
+don't share the GIL with the servers), --mode inproc calls the channel
+and the hub through their Flask test clients without any sockets (no
+view/send there, the client only talks HTTP).
+
+The report (JSON) gives throughput, latency percentiles and errors per
+action and in total, and the lost messages: posts the channel accepted
+that are neither in its window nor in its archive afterwards.
+
+    python loadtest.py --users 16 --duration 10 --backend sqlite
+    python loadtest.py --mode processes --mix post=1,poll=8,view=1 --async
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from benchmark import make_corpus, summarize
+
+ACTIONS = ('post', 'poll', 'channels', 'view', 'send')
+HTTP_ONLY = {'view', 'send'}
+DEFAULT_MIX = 'post=2,poll=6,channels=1,view=1'
+# posts are sent as user<user>-<number>: the profanity filter leaves senders alone
+SENDER = re.compile(r'user(\d+)-(\d+)$')
+STARTUP_TIMEOUT = 30
+
+
+class QuietHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections open, as behind a proxy
+
+    def log_request(self, *args):
+        pass
+
+
+def configure(directory, backend='journal', replies_async=False, window=None, hub_url=None):
+    """Import the three apps, pointed at directory and at each other."""
+    # read by hub.py when it is imported
+    os.environ['HUB_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'hub.sqlite')
+    import channel
+    import client
+    import hub
+    channel.CHANNEL_FILE = os.path.join(directory, 'messages.json')
+    channel.CHANNEL_JOURNAL = os.path.join(directory, 'messages.jsonl')
+    channel.CHANNEL_DATABASE = os.path.join(directory, 'messages.sqlite')
+    channel.CHANNEL_ARCHIVE = os.path.join(directory, 'archive')  # to find every message again
+    channel.CHANNEL_BACKEND = backend
+    channel.ELIZA_ASYNC = replies_async
+    hub.SCHEDULER.lock_path = os.path.join(directory, 'heartbeat.lock')
+    if window:
+        channel.MAIN_ROOM.window = window
+    channel.HUB_AUTHKEY = client.HUB_AUTHKEY = hub.SERVER_AUTHKEY
+    if hub_url:
+        channel.HUB_URL = client.HUB_URL = hub_url
+    return channel, hub, client
+
+
+def channel_record(channel, endpoint):
+    return {'name': channel.CHANNEL_NAME, 'endpoint': endpoint,
+            'authkey': channel.CHANNEL_AUTHKEY,
+            'type_of_service': channel.CHANNEL_TYPE_OF_SERVICE}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            if time.monotonic() > deadline:
+                raise RuntimeError("%s did not come up" % url)
+            time.sleep(0.1)
+
+
+class ThreadServers:
+    """The hub, the channel and the client served by threads of this process."""
+
+    def __init__(self, apps):
+        self.servers = []
+        self.urls = {}
+        for name, app in apps.items():
+            server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+            threading.Thread(target=server.serve_forever, daemon=True,
+                             name='loadtest-' + name).start()
+            self.servers.append(server)
+            self.urls[name] = 'http://127.0.0.1:%d' % server.server_port
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+
+
+class ProcessServers:
+    """The hub, the channel and the client each in a server process of its own."""
+
+    def __init__(self, options):
+        self.processes = []
+        self.urls = {name: 'http://127.0.0.1:%d' % free_port()
+                     for name in ('hub', 'channel', 'client')}
+        for name, url in self.urls.items():
+            command = [sys.executable, os.path.abspath(__file__), '--serve', name,
+                       '--port', url.rsplit(':', 1)[1], '--directory', options.directory,
+                       '--backend', options.backend, '--hub-url', self.urls['hub']]
+            if options.replies_async:
+                command.append('--async')
+            if options.window:
+                command += ['--window', str(options.window)]
+            # their output goes to stderr, stdout is for the report
+            self.processes.append(subprocess.Popen(command, cwd=os.path.dirname(command[1]),
+                                                   stdout=sys.stderr))
+        for url in self.urls.values():
+            wait_until_up(url)
+
+    def stop(self):
+        for process in self.processes:
+            process.send_signal(signal.SIGTERM)
+        for process in self.processes:
+            process.wait()
+
+
+def serve(options):
+    # one server process of --mode processes
+    channel, hub, client = configure(options.directory, options.backend,
+                                     options.replies_async, options.window, options.hub_url)
+    app = {'channel': channel, 'hub': hub, 'client': client}[options.serve].app
+    server = make_server('127.0.0.1', options.port, app, threaded=True,
+                         request_handler=QuietHandler)
+
+    def stop(signum, frame):
+        raise SystemExit(0)  # runs the atexit handlers, e.g. the reply queue's
+
+    signal.signal(signal.SIGTERM, stop)
+    server.serve_forever()
+
+
+class HttpUser:
+    """One simulated user talking HTTP, with a keep-alive session."""
+
+    def __init__(self, urls, endpoint, channel_authkey, hub_authkey):
+        self.session = requests.Session()
+        self.urls = urls
+        self.endpoint = endpoint
+        self.headers = {'Authorization': 'authkey ' + channel_authkey}
+        self.hub_headers = {'Authorization': 'authkey ' + hub_authkey}
+        self.last_id = 0
+        self.etag = None
+
+    def post(self, message):
+        return self.session.post(self.endpoint, json=message, headers=self.headers).status_code == 200
+
+    def poll(self):
+        headers = dict(self.headers)
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        response = self.session.get(self.endpoint, params={'since': self.last_id}, headers=headers)
+        return self.seen(response.status_code, response.headers.get('ETag'),
+                         response.json() if response.status_code == 200 else None)
+
+    def channels(self):
+        return self.session.get(self.urls['hub'] + '/channels',
+                                headers=self.hub_headers).status_code == 200
+
+    def view(self):
+        return self.session.get(self.urls['client'] + '/show',
+                                params={'channel': self.endpoint}).status_code == 200
+
+    def send(self, message):
+        response = self.session.post(self.urls['client'] + '/post', allow_redirects=False,
+                                     data={'channel': self.endpoint,
+                                           'content': message['content'],
+                                           'sender': message['sender']})
+        return response.status_code == 302
+
+    def seen(self, status, etag, messages):
+        if status == 304:
+            return True
+        if status != 200:
+            return False
+        self.etag = etag
+        if messages:
+            self.last_id = messages[-1]['id']
+        return True
+
+
+class InprocUser(HttpUser):
+    """One simulated user calling the apps' test clients."""
+
+    def __init__(self, channel, hub, channel_authkey, hub_authkey):
+        super().__init__({}, '/', channel_authkey, hub_authkey)
+        self.channel = channel.app.test_client()
+        self.hub = hub.app.test_client()
+
+    def post(self, message):
+        return self.channel.post('/', json=message, headers=self.headers).status_code == 200
+
+    def poll(self):
+        headers = dict(self.headers)
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        response = self.channel.get('/?since=%d' % self.last_id, headers=headers)
+        return self.seen(response.status_code, response.headers.get('ETag'),
+                         response.json if response.status_code == 200 else None)
+
+    def channels(self):
+        return self.hub.get('/channels', headers=self.hub_headers).status_code == 200
+
+
+def run_user(number, user, texts, mix, deadline, think, seed):
+    """Act until deadline; returns latencies and errors per action and the accepted posts."""
+    rng = random.Random(seed * 1000 + number)
+    names, weights = zip(*mix.items())
+    latencies = {name: [] for name in names}
+    errors = dict.fromkeys(names, 0)
+    accepted = set()
+    posts = 0
+    clock = time.perf_counter
+    while clock() < deadline:
+        action = rng.choices(names, weights)[0]
+        args = ()
+        if action in ('post', 'send'):
+            posts += 1
+            text = texts[(number * 7919 + posts) % len(texts)]
+            args = ({'content': text,
+                     'sender': 'user%d-%d' % (number, posts),
+                     'timestamp': '2024-01-01T00:00:00'},)
+        start = clock()
+        try:
+            ok = getattr(user, action)(*args)
+        except Exception:
+            ok = False
+        latencies[action].append(clock() - start)
+        if not ok:
+            errors[action] += 1
+        elif args:
+            accepted.add((number, posts))
+        if think:
+            time.sleep(rng.expovariate(1 / think))
+    return latencies, errors, accepted
+
+
+def stored_posts(channel):
+    """(user, number) of every posted message in the channel's window and archive."""
+    store = channel.open_message_store(channel.MAIN_ROOM)
+    try:
+        store.compact()  # archives whatever already left the window
+        messages = list(channel.open_archive(channel.MAIN_ROOM).read()) + store.messages()
+    finally:
+        store.close()
+    found = set()
+    for message in messages:
+        match = SENDER.match(str(message.get('sender', '')))
+        if match:
+            found.add((int(match.group(1)), int(match.group(2))))
+    return found
+
+
+def report(latencies, errors, elapsed):
+    calls = sum(len(values) for values in latencies.values())
+    result = summarize([value for values in latencies.values() for value in values], elapsed)
+    result['errors'] = errors
+    result['error_rate'] = errors / calls if calls else None
+    ordered = sorted(value for values in latencies.values() for value in values)
+    if ordered:
+        result['p90_us'] = ordered[min(len(ordered) - 1, int(0.9 * len(ordered)))] * 1e6
+        result['max_us'] = ordered[-1] * 1e6
+    return result
+
+
+def parse_mix(text, mode):
+    if text is None:
+        # the default mix without what --mode inproc can't do
+        text = ','.join(part for part in DEFAULT_MIX.split(',')
+                        if mode != 'inproc' or part.partition('=')[0] not in HTTP_ONLY)
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError("unknown action %r" % name)
+        if mode == 'inproc' and name in HTTP_ONLY:
+            raise argparse.ArgumentTypeError("%r needs --mode threads or processes" % name)
+        mix[name] = float(weight or 1)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def load_test(options):
+    mix = parse_mix(options.mix, options.mode)
+    channel, hub, client = configure(options.directory, options.backend,
+                                     options.replies_async, options.window)
+    record = channel_record(channel, None)
+    if options.mode == 'inproc':
+        servers = None
+        # no HTTP for the hub's health check, put the channel into its database
+        hub.db.session.add(hub.Channel(**{**record, 'endpoint': 'http://inproc'},
+                                       active=True))
+        hub.db.session.commit()
+        users = [InprocUser(channel, hub, channel.CHANNEL_AUTHKEY, hub.SERVER_AUTHKEY)
+                 for _ in range(options.users)]
+    else:
+        if options.mode == 'threads':
+            servers = ThreadServers({'hub': hub.app, 'channel': channel.app,
+                                     'client': client.app})
+            channel.HUB_URL = client.HUB_URL = servers.urls['hub']
+        else:
+            servers = ProcessServers(options)
+        endpoint = servers.urls['channel']
+        response = requests.post(servers.urls['hub'] + '/channels',
+                                 json={**record, 'endpoint': endpoint},
+                                 headers={'Authorization': 'authkey ' + hub.SERVER_AUTHKEY})
+        if response.status_code != 200:
+            servers.stop()
+            raise RuntimeError("Could not register the channel: " + response.text)
+        users = [HttpUser(servers.urls, endpoint, channel.CHANNEL_AUTHKEY, hub.SERVER_AUTHKEY)
+                 for _ in range(options.users)]
+
+    texts = [text for _, text in make_corpus(1000, options.seed)]
+    results = [None] * len(users)
+
+    def work(number):
+        results[number] = run_user(number, users[number], texts, mix, deadline,
+                                   options.think, options.seed)
+
+    threads = [threading.Thread(target=work, args=(number,)) for number in range(len(users))]
+    start = time.perf_counter()
+    deadline = start + options.duration
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if servers is not None:
+        servers.stop()
+    if options.mode != 'processes':
+        if options.replies_async:
+            channel.REPLIES.join()
+        channel.MAIN_ROOM.unload()
+    accepted = set().union(*(result[2] for result in results))
+    stored = stored_posts(channel)
+
+    actions = {}
+    for name in mix:
+        actions[name] = report({name: [latency for result in results
+                                       for latency in result[0][name]]},
+                               sum(result[1][name] for result in results), elapsed)
+    total = report({name: [latency for result in results for latency in result[0][name]]
+                    for name in mix},
+                   sum(sum(result[1].values()) for result in results), elapsed)
+    return {'meta': {'python': platform.python_version(),
+                     'mode': options.mode,
+                     'backend': options.backend,
+                     'async': options.replies_async,
+                     'users': options.users,
+                     'duration': options.duration,
+                     'think': options.think,
+                     'mix': mix,
+                     'seed': options.seed,
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'total': total,
+            'actions': actions,
+            'messages': {'accepted': len(accepted),
+                         'stored': len(accepted & stored),
+                         'lost': len(accepted - stored)}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('threads', 'processes', 'inproc'), default='threads')
+    parser.add_argument('--users', type=int, default=16, help="simulated users (threads)")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to run")
+    parser.add_argument('--mix', help="action weights (default %s, without %s for --mode inproc)"
+                                      % (DEFAULT_MIX, '/'.join(sorted(HTTP_ONLY))))
+    parser.add_argument('--think', type=float, default=0.0,
+                        help="mean seconds a user waits between actions")
+    parser.add_argument('--backend', choices=('journal', 'sqlite'), default='journal')
+    parser.add_argument('--async', dest='replies_async', action='store_true',
+                        help="answer messages from the background reply queue")
+    parser.add_argument('--window', type=int, help="messages the channel shows")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="also write the report to this JSON file")
+    # used by --mode processes to start the servers
+    parser.add_argument('--serve', choices=('hub', 'channel', 'client'), help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    parser.add_argument('--hub-url', help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+    try:
+        parse_mix(options.mix, options.mode)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    if options.serve:
+        serve(options)
+        return 0
+    # what the apps print goes to stderr, stdout is for the report
+    with tempfile.TemporaryDirectory(prefix='loadtest-') as directory, \
+            contextlib.redirect_stdout(sys.stderr):
+        options.directory = directory
+        result = load_test(options)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    print(text)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text)
+    return 1 if result['messages']['lost'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
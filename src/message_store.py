@@ -0,0 +1,565 @@
+"""
+message_store.py - the channel's messages, in memory and journaled to disk
+
+The channel shows a pinned welcome message followed by the latest
+messages.  MessageStore keeps those in memory (a deque bounded to the
+window size) and makes them durable with an append-only journal: one
+JSON object per line, the welcome message first.  Reading the messages
+doesn't touch the disk, a POST costs one small append, and a restarted
+channel replays the journal to rebuild the window.  Once the journal
+holds compact_after records it is rewritten with just the welcome
+message and the current window.
+
+Besides the number of messages, the window can be limited by age
+(max_age seconds since a message was stored) and by size (max_bytes of
+JSON).  Evicted messages are dropped, or handed to an Archive
+(archive.py) when the journal is compacted; until then the journal
+still holds them, so a crash doesn't lose them.
+
+Every message gets an 'id' when it is stored, increasing by one per
+message and never reused, so clients can ask for what is new since the
+last id they saw.
+
+By default one process owns the journal.  With shared=True several
+processes (e.g. pre-forked WSGI workers) can use the same journal: writes
+are serialized with a lock file, and every read first picks up what the
+other processes appended (one stat() when nothing changed).
+
+SQLiteStore offers the same interface on an SQLite database in WAL mode,
+for deployments with several worker processes: each POST is one
+transaction holding both messages and the retention trim.
+"""
+
+import contextlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import deque
+
+from per_process import PerProcess, fcntl
+
+
+class MessageStore:
+    def __init__(self, path, window=24, welcome=None, compact_after=None,
+                 legacy_file=None, shared=False, max_age=None, max_bytes=None, archive=None):
+        """path: the journal file
+        window: how many messages are kept besides the welcome message
+        welcome: callable returning the welcome message for a new channel
+        compact_after: journal records that trigger a compaction
+        legacy_file: a JSON list of messages to start from if there is no journal yet
+        max_age, max_bytes: further limits of the window, None for none
+        archive: an Archive for the evicted messages
+        """
+        self.path = path
+        self.max_messages = window
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.archive = archive
+        # the window, with each message's size and time it was stored
+        self.window = deque()
+        self.sizes = deque()
+        self.stored = deque()
+        self.window_bytes = 0
+        self.evicted = []     # evicted since the last compaction, for the archive
+        self.welcome_factory = welcome or (lambda: {'content': 'Welcome!', 'sender': 'channel'})
+        self.compact_after = compact_after or max(8 * window, 64)
+        self.legacy_file = legacy_file
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.welcome = None
+        self.loaded = False
+        self.journal = None   # the journal, open for appending
+        self.inode = None     # which file the journal is, to notice compactions
+        self.offset = 0       # bytes of the journal replayed so far
+        self.records = 0      # lines in the journal
+        self.last_id = 0      # id of the newest message
+        self.compactions = 0
+
+    def messages(self):
+        """The welcome message and the current window, oldest first."""
+        with self.lock:
+            self._refresh()
+            return [self.welcome, *self.window]
+
+    def version(self):
+        """(oldest, newest id) of the window: changes whenever messages() does."""
+        with self.lock:
+            self._refresh()
+            return self.window[0]['id'] if self.window else 0, self.last_id
+
+    def append(self, *messages):
+        """Add messages with one write to the journal, return them with their ids."""
+        with self.lock, self._file_lock():
+            if not self.loaded:
+                self._load()
+            elif self.shared:
+                self._catch_up()
+            messages = [self._number(message) for message in messages]
+            now = time.time()
+            lines = [self._encode(message, now) for message in messages]
+            data = b''.join(lines)
+            self.journal.write(data)
+            self.offset += len(data)
+            self.records += len(messages)
+            for message, line in zip(messages, lines):
+                self._admit(message, len(line), now)
+            self._evict(now)
+            if self.records >= self.compact_after:
+                self._compact()
+            return messages
+
+    def compact(self):
+        """Rewrite the journal with only the messages still shown."""
+        with self.lock, self._file_lock():
+            if not self.loaded:
+                self._load()
+            elif self.shared:
+                self._catch_up()
+            self._compact()
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            self.loaded = False
+
+    def stats(self):
+        with self.lock:
+            return {'window': len(self.window),
+                    'window_size': self.max_messages,
+                    'window_bytes': self.window_bytes,
+                    'max_age': self.max_age,
+                    'max_bytes': self.max_bytes,
+                    'journal_records': self.records,
+                    'journal_bytes': self.offset,
+                    'compactions': self.compactions,
+                    'archive': self.archive.stats() if self.archive else None}
+
+    def _number(self, message):
+        self.last_id += 1
+        return {**message, 'id': self.last_id}
+
+    @staticmethod
+    def _encode(message, stored=None):
+        # journal records carry the time they were stored, for max_age
+        if stored is not None:
+            message = {**message, '_stored': stored}
+        return json.dumps(message).encode('utf-8') + b'\n'
+
+    def _admit(self, message, size, stored):
+        self.window.append(message)
+        self.sizes.append(size)
+        self.stored.append(stored)
+        self.window_bytes += size
+
+    def _evict(self, now=None):
+        # drop the oldest messages until the window is within all its limits
+        window = self.window
+        oldest = None if self.max_age is None else (now or time.time()) - self.max_age
+        while window and (len(window) > self.max_messages
+                          or (self.max_bytes is not None and self.window_bytes > self.max_bytes)
+                          or (oldest is not None and self.stored[0] < oldest)):
+            message = window.popleft()
+            self.window_bytes -= self.sizes.popleft()
+            self.stored.popleft()
+            if self.archive is not None:
+                self.evicted.append(message)
+
+    def _refresh(self):
+        # the window as it is now, with other processes' appends and aged messages
+        if not self.loaded:
+            with self._file_lock():
+                self._load()
+        elif self.shared and not self._catch_up(reload=False):
+            # reloading can rewrite the journal, so only under the lock appends hold
+            with self._file_lock():
+                self._catch_up()
+        if self.max_age is not None:
+            self._evict()
+
+    def _file_lock(self):
+        if not self.shared or fcntl is None:
+            return contextlib.nullcontext()
+        return _FileLock(self.path + '.lock')
+
+    def _load(self):
+        # rebuild the window from the journal, or start a new journal
+        self.welcome = None
+        for entries in (self.window, self.sizes, self.stored):
+            entries.clear()
+        self.window_bytes = 0
+        self.evicted = []
+        self.offset = self.records = self.last_id = 0
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = None
+        if data is not None:
+            self._replay(data)
+        if self.welcome is None:
+            self._start()
+        elif self.offset < len(data):
+            self._compact()  # drop a torn last line before appending after it
+        else:
+            self._open()
+        self.loaded = True
+
+    def _start(self):
+        # a new journal: carry over the old message file, or welcome everyone
+        messages = _read_legacy(self.legacy_file) if self.legacy_file else []
+        self.welcome = self._number(messages[0] if messages else self.welcome_factory())
+        now = time.time()
+        for message in messages[1:]:
+            message = self._number(message)
+            self._admit(message, len(self._encode(message, now)), now)
+        self._compact()
+
+    def _replay(self, data):
+        # apply the complete lines of data; a torn last line waits for its end
+        end = data.rfind(b'\n') + 1
+        now = time.time()
+        for line in data[:end].splitlines():
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue  # damaged record, e.g. from a crash mid-write
+            self.records += 1
+            stored = message.pop('_stored', now)
+            if isinstance(message.get('id'), int):
+                self.last_id = max(self.last_id, message['id'])
+            else:
+                message = self._number(message)  # written before messages had ids
+            if self.welcome is None:
+                self.welcome = message
+            else:
+                self._admit(message, len(line) + 1, stored)
+                self._evict(now)
+        self.offset += end
+
+    def _catch_up(self, reload=True):
+        # pick up records other processes appended, or reload after they compacted;
+        # False if a reload was needed but not allowed
+        # open first and check that file: a compaction between a stat() and
+        # the open() would have us replay the new file from the old offset
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            f = None
+        with f or contextlib.nullcontext():
+            stat = f and os.fstat(f.fileno())
+            if stat is None or stat.st_ino != self.inode or stat.st_size < self.offset:
+                if not reload:
+                    return False
+                self.journal.close()
+                self._load()
+            elif stat.st_size > self.offset:
+                f.seek(self.offset)
+                self._replay(f.read())
+        return True
+
+    def _compact(self):
+        self._evict()
+        if self.evicted:
+            # the journal is about to forget them
+            try:
+                self.archive.write(self.evicted)
+            except OSError as e:
+                print(f"Could not archive {len(self.evicted)} messages: {e}")
+            self.evicted = []
+        data = self._encode(self.welcome) + b''.join(
+            self._encode(message, stored) for message, stored in zip(self.window, self.stored))
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.messages-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)  # mkstemp makes it private to the owner
+        os.replace(tmp, self.path)
+        if self.journal is not None:
+            self.journal.close()
+        self._open()
+        self.offset = len(data)
+        self.records = 1 + len(self.window)
+        self.compactions += 1
+
+    def _open(self):
+        # unbuffered, so every append is a single write() of whole lines
+        self.journal = open(self.path, 'ab', buffering=0)
+        self.inode = os.fstat(self.journal.fileno()).st_ino
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    timestamp TEXT,
+    body TEXT NOT NULL,
+    stored REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS messages_pinned_seq ON messages (pinned, seq);
+CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+"""
+# added after the first version of the table
+COLUMNS = {'stored': 'REAL', 'size': 'INTEGER'}
+INDEXES = "CREATE INDEX IF NOT EXISTS messages_pinned_stored ON messages (pinned, stored);"
+
+
+class SQLiteStore:
+    """MessageStore's interface on an SQLite database that processes can share.
+
+    The ids of the messages are the rows' sequence numbers.
+
+    Every process keeps its own connection and a copy of the last result
+    of messages(), which stays valid until some connection commits (SQLite's
+    data_version tells) or, with max_age, until its oldest message expires.
+
+    Reads only ever return the messages within the limits.  Without an
+    archive the rows beyond them are deleted by every append; with one,
+    every evict_every-th append deletes them and archives them as one
+    compressed member.
+    """
+
+    def __init__(self, path, window=24, welcome=None, legacy_file=None, timeout=10.0,
+                 max_age=None, max_bytes=None, archive=None, evict_every=32):
+        self.path = path
+        self.window = window
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.archive = archive
+        self.evict_every = evict_every if archive is not None else 1
+        self.welcome_factory = welcome or (lambda: {'content': 'Welcome!', 'sender': 'channel'})
+        self.legacy_file = legacy_file
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # connect lazily and again after a fork, connections can't be inherited
+        self.connection = PerProcess(self._connect)
+        self.appends = 0
+        self.cached = None    # (data_version, valid until, messages)
+        # the window: newest first, then whatever limits apply
+        limits = []
+        if max_age is not None:
+            limits.append('(stored IS NULL OR stored >= :oldest)')
+        if max_bytes is not None:
+            limits.append('total <= :max_bytes')
+        self.window_query = (
+            'SELECT seq, body, stored FROM (SELECT seq, body, stored, '
+            'SUM(size) OVER (ORDER BY seq DESC) AS total FROM messages '
+            'WHERE pinned = 0 ORDER BY seq DESC LIMIT :window) %s ORDER BY seq'
+            % ('WHERE ' + ' AND '.join(limits) if limits else ''))
+        # ... and all rows outside of it, in one DELETE
+        beyond = ['seq <= (SELECT seq FROM messages WHERE pinned = 0 '
+                  'ORDER BY seq DESC LIMIT 1 OFFSET :window)']
+        if max_age is not None:
+            beyond.append('stored < :oldest')
+        if max_bytes is not None:
+            beyond.append('seq <= (SELECT max(seq) FROM (SELECT seq, SUM(size) OVER '
+                          '(ORDER BY seq DESC) AS total FROM messages WHERE pinned = 0) '
+                          'WHERE total > :max_bytes)')
+        self.evict_query = ('DELETE FROM messages WHERE pinned = 0 AND (%s)'
+                            % ' OR '.join(beyond))
+        if archive is not None:
+            self.evict_query += ' RETURNING seq, body'
+
+    def messages(self):
+        """The welcome message and the current window, oldest first."""
+        with self.lock:
+            return list(self._current())
+
+    def version(self):
+        """(oldest, newest id) of the window: changes whenever messages() does."""
+        with self.lock:
+            messages = self._current()
+            return messages[1]['id'] if len(messages) > 1 else 0, messages[-1]['id']
+
+    def append(self, *messages):
+        """Add messages and drop the ones that left the window, in one transaction.
+
+        Returns the messages with their ids.
+        """
+        stored = []
+        with self.lock:
+            db = self._db()
+            with self._transaction(db):
+                now = time.time()  # under the write lock, so it grows with seq
+                for message in messages:
+                    body = json.dumps(message)
+                    cursor = db.execute('INSERT INTO messages (timestamp, body, stored, size) '
+                                        'VALUES (?, ?, ?, ?)',
+                                        (message.get('timestamp'), body, now, len(body)))
+                    stored.append({**message, 'id': cursor.lastrowid})
+                self.appends += 1
+                if self.appends % self.evict_every == 0:
+                    self._evict(db, now)
+            # our own commits don't change our data_version
+            self.cached = None
+        return stored
+
+    def compact(self):
+        """Evict and archive what left the window, then fold the
+        write-ahead log back into the database file."""
+        with self.lock:
+            db = self._db()
+            with self._transaction(db):
+                self._evict(db, time.time())
+            self.cached = None
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        with self.lock:
+            if self.connection.ready:
+                self.connection.get().close()
+            self.connection.reset()
+            self.cached = None
+
+    def stats(self):
+        with self.lock:
+            rows, size = self._db().execute('SELECT count(*), total(size) FROM messages '
+                                            'WHERE pinned = 0').fetchone()
+            return {'window_size': self.window,
+                    'max_age': self.max_age,
+                    'max_bytes': self.max_bytes,
+                    'rows': rows,
+                    'row_bytes': int(size),
+                    'database': self.path,
+                    'archive': self.archive.stats() if self.archive else None}
+
+    def _current(self):
+        # the cached messages, read again if they changed or expired
+        db = self._db()
+        version = db.execute('PRAGMA data_version').fetchone()[0]
+        now = time.time()
+        if self.cached is not None and self.cached[0] == version and now < self.cached[1]:
+            return self.cached[2]
+        rows = db.execute('SELECT seq, body, stored FROM messages WHERE pinned = 1 '
+                          'ORDER BY seq LIMIT 1').fetchall()
+        window = db.execute(self.window_query, self._limits(now)).fetchall()
+        messages = [{**json.loads(body), 'id': seq} for seq, body, _ in rows + window]
+        expires = float('inf')
+        if self.max_age is not None and window:
+            expires = min(stored or now for _, _, stored in window) + self.max_age
+        self.cached = (version, expires, messages)
+        return messages
+
+    def _limits(self, now):
+        return {'window': self.window, 'max_bytes': self.max_bytes,
+                'oldest': now - self.max_age if self.max_age is not None else None}
+
+    def _evict(self, db, now):
+        evicted = db.execute(self.evict_query, self._limits(now)).fetchall()
+        if self.archive is not None and evicted:
+            # RETURNING gives no order
+            try:
+                self.archive.write([{**json.loads(body), 'id': seq}
+                                    for seq, body in sorted(evicted)])
+            except OSError as e:
+                print(f"Could not archive {len(evicted)} messages: {e}")
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _transaction(db):
+        # take the write lock up front instead of upgrading a read lock
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _db(self):
+        return self.connection.get()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=self.timeout,
+                             isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SCHEMA)
+        with self._transaction(db):
+            columns = {row[1] for row in db.execute('PRAGMA table_info(messages)')}
+            for column, kind in COLUMNS.items():
+                if column not in columns:
+                    db.execute('ALTER TABLE messages ADD COLUMN %s %s' % (column, kind))
+            if 'size' not in columns:
+                db.execute('UPDATE messages SET size = length(body) WHERE pinned = 0')
+            db.execute(INDEXES)
+            if db.execute('SELECT 1 FROM messages WHERE pinned = 1').fetchone() is None:
+                self._start(db)
+        self.cached = None
+        return db
+
+    def _start(self, db):
+        # a new database: carry over the old message file, or welcome everyone
+        messages = _read_legacy(self.legacy_file) if self.legacy_file else []
+        welcome = messages[0] if messages else self.welcome_factory()
+        now = time.time()
+        db.execute('INSERT INTO messages (pinned, timestamp, body) VALUES (1, ?, ?)',
+                   (welcome.get('timestamp'), json.dumps(welcome)))
+        db.executemany('INSERT INTO messages (timestamp, body, stored, size) VALUES (?, ?, ?, ?)',
+                       [(message.get('timestamp'), body, now, len(body))
+                        for message in messages[1:][-self.window:]
+                        for body in (json.dumps(message),)])
+
+
+class MessageFeed:
+    """Wakes up the threads waiting for new messages (the /stream subscribers).
+
+    Waiting threads sleep on one condition until publish() announces a
+    newer id or their timeout runs out, so idle subscribers cost a parked
+    thread and nothing else.  join()/leave() count them; how many are let
+    in is up to the caller (the channel's STREAM_SLOTS).
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.last_id = 0
+        self.subscribers = 0
+
+    def publish(self, last_id):
+        with self.condition:
+            if last_id > self.last_id:
+                self.last_id = last_id
+                self.condition.notify_all()
+
+    def wait(self, after_id, timeout):
+        """Wait until a message newer than after_id is published; False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.last_id > after_id, timeout)
+
+    def join(self):
+        with self.condition:
+            self.subscribers += 1
+
+    def leave(self):
+        with self.condition:
+            self.subscribers -= 1
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def _read_legacy(path):
+    # the JSON list channel.py used to rewrite on every message
+    try:
+        with open(path) as f:
+            messages = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return messages if isinstance(messages, list) else []
@@ -0,0 +1,49 @@
+"""
+per_process.py - state each worker process needs its own copy of
+
+Threads, thread pools, sockets and database connections don't survive a
+fork: a pre-forked WSGI worker inherits the parent's objects but not
+their threads, and sharing a connection with the parent corrupts it.
+PerProcess makes such a thing lazily, the first time a process asks for
+it, and again in every child forked after that.
+
+fcntl is imported here for the cross-process file locks; it is None
+where there is no fcntl (Windows), and the callers then skip locking.
+"""
+
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locking on Windows
+    fcntl = None
+
+
+class PerProcess:
+    def __init__(self, setup):
+        """setup: called without arguments, returns the value for this process"""
+        self.setup = setup
+        self.lock = threading.Lock()
+        self.pid = None
+        self.value = None
+
+    def get(self):
+        """The value for this process, made by setup() on first use."""
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.value = self.setup()
+                    self.pid = os.getpid()
+        return self.value
+
+    @property
+    def ready(self):
+        """Whether this process made its value already."""
+        return self.pid == os.getpid()
+
+    def reset(self):
+        """Forget the value (e.g. after closing it), the next get() makes a new one."""
+        with self.lock:
+            self.pid = None
+            self.value = None
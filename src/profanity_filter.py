@@ -0,0 +1,151 @@
+"""
+profanity_filter.py - single pass profanity scanner
+
+Censors the same words as better_profanity (same word list, same
+leetspeak table, same rules for words split by spaces or separators),
+but looks them up in a trie while walking the text once instead of
+comparing every word against every entry of the word list.
+"""
+
+import re
+from collections import namedtuple
+
+from better_profanity import profanity as _better_profanity
+from better_profanity.constants import ALLOWED_CHARACTERS
+from better_profanity.utils import get_complete_path_of_file, read_wordlist
+
+# profane: did the text contain a swear word, censored: the text with
+# every swear word replaced by '****'
+ScanResult = namedtuple('ScanResult', ['profane', 'censored'])
+
+CENSOR = '****'
+
+
+def _unchanged(text):
+    return text
+
+
+class _Node:
+    __slots__ = ('next', 'end')
+
+    def __init__(self):
+        self.next = {}    # text character -> list of child nodes
+        self.end = False  # a word of the list ends here
+
+
+class ProfanityFilter:
+    def __init__(self, words=None, char_map=None):
+        if words is None:
+            words = read_wordlist(get_complete_path_of_file('profanity_wordlist.txt'))
+        if char_map is None:
+            char_map = _better_profanity.CHARS_MAPPING
+        self.char_map = char_map
+        self.root = _Node()
+        self.max_combinations = 1
+        children = {}  # (node id, word character) -> child, while building
+        for word in set(w.lower() for w in words):
+            self.max_combinations = max(self.max_combinations,
+                                        sum(1 for c in word if c not in ALLOWED_CHARACTERS))
+            node = self.root
+            for char in word:
+                child = children.get((id(node), char))
+                if child is None:
+                    child = children[id(node), char] = _Node()
+                    # a character of the word also matches its leetspeak variants
+                    for variant in char_map.get(char, (char,)):
+                        node.next.setdefault(variant, []).append(child)
+                node = child
+            node.end = True
+        # words are runs of the characters better_profanity allows in words
+        self.word_pattern = re.compile('[%s]+' % ''.join(
+            re.escape(c) for c in sorted(ALLOWED_CHARACTERS)))
+
+    def _walk(self, nodes, text):
+        # all trie nodes reachable from nodes by reading text
+        for char in text:
+            if len(nodes) == 1:
+                nodes = nodes[0].next.get(char)
+                if not nodes:
+                    return ()
+            else:
+                nodes = [child for node in nodes for child in node.next.get(char, ())]
+                if not nodes:
+                    return ()
+        return nodes
+
+    def scan(self, text, lowered=None):
+        """Return ScanResult(profane, censored) for text in one pass.
+
+        Pass lowered if the caller already has text.lower() at hand.
+        """
+        if not isinstance(text, str):
+            text = str(text)
+        if lowered is None or len(lowered) != len(text):
+            # lowercase word by word (lower() can change the length)
+            source, lower = text, str.lower
+        else:
+            source, lower = lowered, _unchanged
+        words = [(m.start(), m.end()) for m in self.word_pattern.finditer(text)]
+        # better_profanity leaves text alone whose only word starts at the
+        # very last character, and never joins such a word to the one before
+        if not words or words[0][0] >= len(text) - 1:
+            return ScanResult(False, text)
+        if words[-1][0] >= len(text) - 1:
+            last = len(words) - 1
+        else:
+            last = len(words)
+        root = [self.root]
+        out = []
+        pos = 0
+        profane = False
+        i = 0
+        while i < len(words):
+            start, end = words[i]
+            nodes = self._walk(root, lower(source[start:end]))
+            if not nodes:
+                i += 1
+                continue
+            # join the following words, glued together or with the
+            # separators in between; the shortest run that forms a word wins
+            joined = separated = nodes
+            hit = None
+            for j in range(i + 1, min(i + 1 + self.max_combinations, last)):
+                next_word = lower(source[words[j][0]:words[j][1]])
+                if joined:
+                    joined = self._walk(joined, next_word)
+                if separated:
+                    separated = self._walk(
+                        separated, lower(source[words[j-1][1]:words[j][0]]) + next_word)
+                if not joined and not separated:
+                    break
+                if any(n.end for n in joined) or any(n.end for n in separated):
+                    hit = j
+                    break
+            if hit is not None:
+                out.append(text[pos:start])
+                out.append(CENSOR)
+                # the separator after the first word goes with the run
+                pos = words[hit][1]
+                profane = True
+                i = hit + 1
+                continue
+            if any(n.end for n in nodes):
+                out.append(text[pos:start])
+                out.append(CENSOR)
+                pos = end
+                profane = True
+            i += 1
+        if not profane:
+            return ScanResult(False, text)
+        out.append(text[pos:])
+        return ScanResult(True, ''.join(out))
+
+    def contains_profanity(self, text):
+        return self.scan(text).profane
+
+    def censor(self, text):
+        return self.scan(text).censored
+
+
+# built once per process from better_profanity's word list
+DEFAULT_FILTER = ProfanityFilter()
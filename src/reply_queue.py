@@ -0,0 +1,122 @@
+"""
+reply_queue.py - answer channel messages in background threads
+
+With ELIZA_ASYNC on, the channel stores a posted message, puts it on a
+ReplyQueue and returns.  Worker threads take the queued messages off in
+batches (whatever arrived while the previous batch was being answered,
+up to batch_size) and hand each batch to the channel, which answers them
+with one respond_many() call and stores the replies with one append.
+
+The queue holds at most maxsize messages.  submit() waits up to
+put_timeout for room and returns False if there is none, so the caller
+can answer the message itself: a full queue slows posters down instead
+of dropping replies.  stats() shows the depth and how long messages
+waited before they were answered.
+"""
+
+import atexit
+import queue
+import threading
+import time
+
+from per_process import PerProcess
+
+
+class ReplyQueue:
+    def __init__(self, handle, workers=2, maxsize=1000, batch_size=32, put_timeout=0.1):
+        """handle: called with a list of submitted items, from a worker thread"""
+        self.handle = handle
+        self.workers = workers
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.threads = PerProcess(self._spawn)
+        self.submitted = 0
+        self.rejected = 0     # queue full, answered by the poster
+        self.answered = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_lag = 0.0   # seconds the last answered message waited
+        self.max_lag = 0.0
+
+    def submit(self, item):
+        """Queue item for the workers; False if the queue stayed full."""
+        self._start()
+        try:
+            self.queue.put((time.monotonic(), item), timeout=self.put_timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.submitted += 1
+        return True
+
+    def join(self):
+        """Wait until everything submitted so far is answered."""
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            return {'depth': self.queue.qsize(),
+                    'maxsize': self.queue.maxsize,
+                    'workers': self.workers,
+                    'submitted': self.submitted,
+                    'rejected': self.rejected,
+                    'answered': self.answered,
+                    'batches': self.batches,
+                    'failures': self.failures,
+                    'mean_batch': self.answered / self.batches if self.batches else None,
+                    'last_lag_ms': self.last_lag * 1e3,
+                    'max_lag_ms': self.max_lag * 1e3}
+
+    def _start(self):
+        # threads don't survive a fork, start them in the process that serves
+        self.threads.get()
+
+    def _spawn(self):
+        threads = [threading.Thread(target=self._work, daemon=True,
+                                    name='eliza-reply-%d' % number)
+                   for number in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        atexit.register(self._drain)
+        return threads
+
+    def _take(self):
+        # block for one message, then take whatever else is already waiting
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            self._answer(self._take())
+
+    def _answer(self, batch):
+        lag = time.monotonic() - batch[0][0]
+        try:
+            self.handle([item for _, item in batch])
+        except Exception as e:
+            with self.lock:
+                self.failures += 1
+            print(f"Could not answer {len(batch)} queued messages: {e}")
+        finally:
+            with self.lock:
+                self.answered += len(batch)
+                self.batches += 1
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+            for _ in batch:
+                self.queue.task_done()
+
+    def _drain(self, timeout=5.0):
+        # answer what is still queued when the process exits
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
@@ -0,0 +1,123 @@
+"""
+rooms.py - several chat rooms served by one channel process
+
+Every room has its own name, authkey, hub endpoint and message store;
+the Eliza rules and the profanity filter are shared by all of them.  A
+room's store is opened on first use and closed again by
+RoomRegistry.unload_idle() once nobody used the room for idle_timeout
+seconds (and no /stream subscriber is waiting on it).
+"""
+
+import contextlib
+import threading
+import time
+
+from encoded_window import EncodedWindow
+from message_store import MessageFeed
+
+# path segments the channel's own routes use, rooms can't be called that
+RESERVED = {'health', 'stats', 'stream', 'batch', 'static'}
+
+
+class Room:
+    def __init__(self, slug, name, authkey, endpoint, open_store, window=25):
+        """open_store: called with the room, returns its message store;
+        window: messages shown, including the welcome message (CHANNEL_WINDOW)
+        """
+        self.slug = slug
+        self.name = name
+        self.authkey = authkey
+        self.endpoint = endpoint
+        self.window = window
+        self.open_store = open_store
+        self.feed = MessageFeed()
+        self.lock = threading.Lock()
+        self.store = None
+        self.encoded_window = None
+        self.in_use = 0       # requests working with the store right now
+        self.last_used = time.monotonic()
+
+    @contextlib.contextmanager
+    def using(self):
+        # the store, kept open while the caller works with it
+        with self.lock:
+            if self.store is None:
+                self.store = self.open_store(self)
+            self.in_use += 1
+            self.last_used = time.monotonic()
+            store = self.store
+        try:
+            yield store
+        finally:
+            with self.lock:
+                self.in_use -= 1
+
+    def messages(self):
+        with self.using() as store:
+            return store.messages()
+
+    def append(self, *messages):
+        """Store messages and wake up the room's /stream subscribers."""
+        with self.using() as store:
+            stored = store.append(*messages)
+        self.feed.publish(stored[-1]['id'])
+        return stored
+
+    def encoded(self, encode, gzip_level=6):
+        """The window as an EncodedWindow, encoded again only after it changed."""
+        with self.using() as store:
+            version = store.version()
+            encoded = self.encoded_window
+            if encoded is None or encoded.store is not store or encoded.version != version:
+                encoded = EncodedWindow(store, version, store.messages(), encode, gzip_level)
+                self.encoded_window = encoded
+        return encoded
+
+    def stats(self):
+        with self.using() as store:
+            return store.stats()
+
+    def unload(self, idle_timeout=0):
+        """Close the store if the room is idle; True if it was closed."""
+        with self.lock:
+            if (self.store is None or self.in_use or self.feed.subscribers
+                    or time.monotonic() - self.last_used < idle_timeout):
+                return False
+            self.store.close()
+            self.store = None
+            self.encoded_window = None
+            return True
+
+
+class RoomRegistry:
+    def __init__(self, idle_timeout=600):
+        self.idle_timeout = idle_timeout
+        self.rooms = {}
+        self.next_sweep = time.monotonic() + idle_timeout
+
+    def add(self, room):
+        if room.slug in RESERVED or '/' in room.slug:
+            raise ValueError("Can't name a room %r" % room.slug)
+        if room.slug in self.rooms:
+            raise ValueError("Room %r exists twice" % room.slug)
+        self.rooms[room.slug] = room
+        return room
+
+    def get(self, slug):
+        """The room called slug, or None; now and then unloads idle rooms."""
+        if time.monotonic() >= self.next_sweep:
+            self.next_sweep = time.monotonic() + self.idle_timeout
+            self.unload_idle()
+        return self.rooms.get(slug)
+
+    def unload_idle(self):
+        return sum(room.unload(self.idle_timeout) for room in list(self.rooms.values()))
+
+    def loaded(self):
+        return sum(room.store is not None for room in self.rooms.values())
+
+    def __iter__(self):
+        return iter(list(self.rooms.values()))
+
+    def __len__(self):
+        return len(self.rooms)
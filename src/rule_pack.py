@@ -0,0 +1,153 @@
+"""
+rule_pack.py - Eliza rule packs loaded from JSON or YAML files
+
+A rule pack holds the same tables as eliza.py (gReflections and gPats):
+
+    {"reflections": {"am": "are", "i": "you", ...},
+     "patterns": [["I need (.*)", ["Why do you need %1?", "..."]], ...]}
+
+YAML files (.yaml/.yml) with the same structure work if PyYAML is
+installed.  load_rules() checks and compiles a pack into a RuleSet.
+RuleSetReloader watches a pack and swaps in a freshly compiled rule set
+when the file changes.
+
+The built-in tables in eliza.py remain the default; dump_pack() writes
+them out as a starting point for a pack.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+
+from eliza import RuleSet, gPats, gReflections
+
+try:
+    import yaml
+except ImportError:  # YAML packs are optional
+    yaml = None
+
+class RulePackError(ValueError):
+    pass
+
+
+def parse_pack(data, name='rule pack'):
+    """Check a decoded pack, return (pats, reflections) as eliza uses them."""
+    if not isinstance(data, dict) or 'patterns' not in data:
+        raise RulePackError("%s: expected an object with 'patterns'" % name)
+    reflections = data.get('reflections', {})
+    if not isinstance(reflections, dict) or not all(
+            isinstance(k, str) and isinstance(v, str) for k, v in reflections.items()):
+        raise RulePackError("%s: 'reflections' must map words to words" % name)
+    pats = []
+    for number, entry in enumerate(data['patterns']):
+        if (not isinstance(entry, (list, tuple)) or len(entry) != 2
+                or not isinstance(entry[0], str) or not isinstance(entry[1], list)
+                or not entry[1] or not all(isinstance(r, str) for r in entry[1])):
+            raise RulePackError("%s: pattern %d must be [regex, [responses...]]" % (name, number))
+        try:
+            groups = re.compile(entry[0], re.IGNORECASE).groups
+        except re.error as e:
+            raise RulePackError("%s: pattern %d (%r): %s" % (name, number, entry[0], e))
+        for response in entry[1]:
+            for macro in re.findall(r'%([1-9])', response):
+                if int(macro) > groups:
+                    raise RulePackError("%s: pattern %d has no group %s for %r"
+                                        % (name, number, macro, response))
+        pats.append([entry[0], list(entry[1])])
+    return pats, reflections
+
+
+def read_pack(path):
+    """Read and check a JSON or YAML pack file, return (pats, reflections)."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return _decode(path, raw)
+
+
+def _decode(path, raw):
+    if path.endswith(('.yaml', '.yml')):
+        if yaml is None:
+            raise RulePackError("%s: install PyYAML to load YAML rule packs" % path)
+        data = yaml.safe_load(raw)
+    else:
+        data = json.loads(raw)
+    return parse_pack(data, path)
+
+
+def dump_pack(path, pats=gPats, reflections=gReflections):
+    """Write rule tables as a JSON pack (the built-in ones by default)."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'reflections': reflections,
+                   'patterns': [[pattern, responses] for pattern, responses in pats]},
+                  f, indent=2, ensure_ascii=False)
+
+
+def _build(pats, reflections, cache_size, name):
+    try:
+        return RuleSet(pats, reflections, cache_size).warm()
+    except (re.error, IndexError) as e:
+        # RuleIndex keeps the patterns it can't join apart; this is a last guard
+        raise RulePackError("%s: rules can't be combined: %s" % (name, e))
+
+
+def load_rules(path, cache_size=1024):
+    """Check and compile the pack at path into a RuleSet."""
+    pats, reflections = read_pack(path)
+    return _build(pats, reflections, cache_size, path)
+
+
+class RuleSetReloader:
+    """The current RuleSet of a pack file, recompiled when the file changes.
+
+    current() looks at the file at most every check_interval seconds.  A
+    changed pack is compiled by one thread while the others keep using the
+    old rule set; the new one replaces it in a single assignment, so
+    requests that already hold the old rule set finish with it.  A pack
+    that fails to load is reported and the old rules stay in place.
+    """
+
+    def __init__(self, path, cache_size=1024, check_interval=2.0):
+        self.path = path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.reloads = 0
+        self.last_error = None
+        self.stamp = self._stamp()
+        self.rules = load_rules(path, cache_size)
+        self.next_check = time.monotonic() + check_interval
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def current(self):
+        if time.monotonic() >= self.next_check and self.lock.acquire(blocking=False):
+            try:
+                self.next_check = time.monotonic() + self.check_interval
+                stamp = self._stamp()
+                if stamp is not None and stamp != self.stamp:
+                    self.reload(stamp)
+            finally:
+                self.lock.release()
+        return self.rules
+
+    def reload(self, stamp=None):
+        try:
+            rules = load_rules(self.path, self.cache_size)
+        except (OSError, ValueError) as e:
+            # don't retry the same broken file on every check
+            self.stamp = stamp or self._stamp()
+            self.last_error = str(e)
+            print(f"Keeping the old rules, could not load {self.path}: {e}")
+            return False
+        self.stamp = stamp or self._stamp()
+        self.rules = rules
+        self.reloads += 1
+        self.last_error = None
+        return True
@@ -0,0 +1,64 @@
+import re
+
+import pytest
+
+from benchmark import make_corpus, sequential_match
+from eliza import DEFAULT_RULES, Eliza, RuleIndex, Utterance, gReflections
+
+
+CORPUS = [text for _, text in make_corpus(5000, seed=3)]
+
+
+def test_rule_index_matches_like_the_sequential_loop():
+    for text in CORPUS + [text.upper() for text in CORPUS[:500]] + ['', 'Ünïcode ǅ', 'KK']:
+        norm = Utterance(text)
+        assert DEFAULT_RULES.index.match(norm.text, norm.lowered) == \
+            sequential_match(DEFAULT_RULES.keys, norm.text), text
+
+
+@pytest.mark.parametrize('text', ['cats and cats', 'cats and dogs', 'dog or dog',
+                                  'bye\nnow', 'thank you', 'Thank you so much'])
+def test_rule_index_keeps_rules_that_cannot_be_combined_apart(text):
+    patterns = [r'(.*)thank you(.*)', r'(\w+) and \1', r'(?s)bye(.*)',
+                r'(?P<x>\w+) or (?P=x)', r'(.*)']
+    keys = [re.compile(p, re.IGNORECASE) for p in patterns]
+    assert RuleIndex(patterns).match(text) == sequential_match(keys, text)
+
+
+class Pick:
+    # stands in for the rng: always the response number given
+    def __init__(self, number):
+        self.number = number
+
+    def choice(self, seq):
+        return seq[self.number]
+
+
+def legacy_fill(resp, match):
+    # how respond() filled in a response before the templates were compiled
+    therapist = Eliza()
+    pos = resp.find('%')
+    while pos > -1:
+        num = int(resp[pos+1:pos+2])
+        resp = resp[:pos] + therapist.translate(match.group(num), gReflections) + resp[pos+2:]
+        pos = resp.find('%')
+    if resp[-2:] == '?.': resp = resp[:-2] + '.'
+    if resp[-2:] == '??': resp = resp[:-2] + '?'
+    return resp
+
+
+def test_templates_render_like_the_old_substitution():
+    therapist = Eliza()
+    checked = 0
+    for text in CORPUS + ['I need ??', 'I am sad?.', 'because ?']:
+        found = therapist._check_rules(Utterance(text))
+        if not found:
+            continue
+        _, i, _ = found
+        match = DEFAULT_RULES.keys[i].match(text)
+        if None in match.groups():
+            continue  # the old code couldn't fill in a group that didn't match
+        for number, resp in enumerate(DEFAULT_RULES.values[i]):
+            assert therapist.render(found, 'bob', Pick(number)) == legacy_fill(resp, match)
+            checked += 1
+    assert checked > 1000
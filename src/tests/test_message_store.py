@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from benchmark import bench_concurrent, make_corpus
+from message_store import MessageStore
+
+
+def welcome():
+    return {'sender': 'Eliza', 'content': 'Welcome'}
+
+
+def post(store, number):
+    return store.append({'sender': 'user', 'content': 'message %d' % number})
+
+
+def test_journal_replay_skips_a_torn_last_line(tmp_path):
+    path = str(tmp_path / 'messages.jsonl')
+    store = MessageStore(path, window=10, welcome=welcome)
+    for number in range(3):
+        post(store, number)
+    before = store.messages()
+    store.close()
+    with open(path, 'ab') as f:
+        f.write(b'{"sender": "user", "content": "cut o')  # a crash mid-write
+
+    store = MessageStore(path, window=10, welcome=welcome)
+    assert store.messages() == before
+    post(store, 3)
+    after = store.messages()
+    store.close()
+    assert after[:-1] == before and after[-1]['content'] == 'message 3'
+    assert MessageStore(path, window=10, welcome=welcome).messages() == after
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'journal'])
+def test_parallel_posters_lose_no_messages(backend):
+    result = bench_concurrent(backend, make_corpus(100, seed=7), 7, posters=4, posts=50)
+    assert result['errors'] == 0
+    assert result['lost'] == 0
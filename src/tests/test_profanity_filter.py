@@ -0,0 +1,17 @@
+from better_profanity import profanity
+
+from benchmark import PROFANITY, make_corpus, sized_messages
+from profanity_filter import DEFAULT_FILTER
+
+
+CORPUS = make_corpus(300, seed=5)
+
+
+def test_scan_agrees_with_better_profanity():
+    texts = [text for _, text in CORPUS] + sized_messages(CORPUS, 5, 10, None, 100) + \
+        sized_messages(CORPUS, 6, 100, None, 3) + PROFANITY + \
+        ['', 'SHIT!', 'sh1t happens', 'a$$hole', 'f u c k', 'Scunthorpe', 'shitshit', 'ok... shit.']
+    for text in texts:
+        result = DEFAULT_FILTER.scan(text)
+        assert result.profane == profanity.contains_profanity(text), text
+        assert result.censored == profanity.censor(text), text